@@ -0,0 +1,62 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+__all__ = [
+    'MISSING',
+    'TTLCache',
+]
+
+MISSING = object()
+
+
+class TTLCache:
+    # bounded LRU cache, every entry carries its own time-to-live
+
+    def __init__(self, maxsize: int):
+        self._maxsize = maxsize
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: Hashable, default=MISSING):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value, ttl: float):
+        if self._maxsize <= 0 or ttl <= 0:
+            return
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self._maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def info(self) -> dict:
+        return dict(
+            size=len(self._data),
+            maxsize=self._maxsize,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+        )
@@ -17,5 +17,39 @@ ENV = {
 # process booleans
 for key in [
     'DEBUG',
+    'SHARED_STATE',
 ]:
     ENV[key] = utils.my_bool(ENV[key])
+
+# process integers
+for key in [
+    'EXISTIO_CONNECTION_LIMIT',
+    'EXISTIO_DNS_CACHE_TTL',
+    'EXISTIO_CACHE_SIZE',
+    'EXISTIO_RATE_BURST',
+    'EXISTIO_MAX_IN_FLIGHT',
+    'EXISTIO_MAX_RETRIES',
+    'DATA_COMPACT_THRESHOLD',
+    'QUEUE_WORKERS',
+    'QUEUE_MAX_ATTEMPTS',
+    'DEDUP_MAX_SIZE',
+    'QUEUE_MAX_PENDING',
+    'QUEUE_RETRY_AFTER',
+]:
+    ENV[key] = int(ENV[key])
+
+# process floats
+for key in [
+    'EXISTIO_TIMEOUT',
+    'EXISTIO_CACHE_TTL_CLOSED',
+    'EXISTIO_CACHE_TTL_CURRENT',
+    'EXISTIO_UPDATE_WINDOW',
+    'EXISTIO_RATE_LIMIT',
+    'STATS_DEBOUNCE_SECONDS',
+    'SLOW_JOB_SECONDS',
+    'DAEMON_INTERVAL',
+    'ADMIN_POLL_INTERVAL',
+    'QUEUE_BACKOFF_BASE',
+    'DEDUP_TTL',
+]:
+    ENV[key] = float(ENV[key])
@@ -1,15 +1,126 @@
+import asyncio
+import fcntl
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+from contextlib import asynccontextmanager
+
 import aiofiles
 from aiofiles import ospath
 
+from metrics import DATA_MANAGER_LATENCY
+
+__all__ = [
+    'DataManager',
+    'JournalDataManager',
+    'SQLiteDataManager',
+    'create_data_manager',
+]
+
+logger = logging.getLogger(__name__)
+
+
+def write_atomic(filename: str, text: str, mode: int = 0o644):
+    # temp file + rename: readers see either the old or the new file, never a half-written one;
+    # every write has its own temp file, so concurrent writes can not clobber each other's
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_filename = tempfile.mkstemp(dir=dirname, prefix=f'{os.path.basename(filename)}.', suffix='.tmp')
+    try:
+        # mkstemp creates it readable for the owner only
+        os.fchmod(fd, mode)
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.unlink(tmp_filename)
+        raise
+    dir_fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def file_version(*filenames: str) -> tuple:
+    # changes whenever any of the files is replaced or appended to
+    version = []
+    for filename in filenames:
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            version.append(None)
+        else:
+            version.append((stat.st_ino, stat.st_mtime_ns, stat.st_size))
+    return tuple(version)
+
+
+def parse_line(line: str):
+    r = line.strip().split(':', maxsplit=1)
+    if len(r) == 2:
+        return r
+    return None
+
 
 class DataManager:
+    # With `shared` several processes (uvicorn workers, script runs) use the same files:
+    # the mapping is reloaded whenever the files changed on disk and every change is made under an exclusive
+    # `flock` of `<filename>.lock`, on top of the freshly reloaded mapping.
+
     _filename = None
     _data: dict = None
 
-    def __init__(self, filename):
+    def __init__(self, filename, shared=False):
         self._filename = filename
+        self._shared = shared
+        # version of the files the mapping was loaded from
+        self._version = None
+        self._file_locked = False
+        # guards loading and saving of the whole mapping
+        self._lock = asyncio.Lock()
+
+    def _file_version(self) -> tuple:
+        return file_version(self._filename)
+
+    def _stale(self) -> bool:
+        return self._shared and self._file_version() != self._version
+
+    async def _ensure_loaded(self):
+        if self._data is None or self._stale():
+            async with self._lock:
+                if self._data is None or self._stale():
+                    with DATA_MANAGER_LATENCY.time(operation='load'):
+                        await self._load()
+
+    @asynccontextmanager
+    async def _file_lock(self):
+        # cross-process lock for the changes, a no-op unless shared
+        if not self._shared:
+            yield
+            return
+        fd = os.open(f'{self._filename}.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(.01)
+            self._file_locked = True
+            # somebody else could have changed the files while we were waiting
+            if self._stale():
+                await self._load()
+            yield
+        finally:
+            self._file_locked = False
+            os.close(fd)
 
     async def _load(self):
+        self._version = self._file_version()
         self._data = dict()
         file_exists = await ospath.exists(self._filename)
         if not file_exists:
@@ -17,38 +128,336 @@ class DataManager:
         async with aiofiles.open(self._filename, 'r') as f:
             lines = await f.readlines()
             for line in lines:
-                r = line.strip().split(':', maxsplit=1)
-                if len(r) == 2:
+                r = parse_line(line)
+                if r:
                     task_id, tag = r
                     self._data[task_id] = tag
 
-    async def _save(self):
+    def _dump(self) -> str:
         lines = [
             f'{task_id}:{tag}'
             for task_id, tag in self._data.items()
         ]
-        async with aiofiles.open(self._filename, 'w') as f:
-            await f.write('\n'.join(lines))
+        return '\n'.join(lines)
+
+    async def _save(self):
+        with DATA_MANAGER_LATENCY.time(operation='save'):
+            await asyncio.to_thread(write_atomic, self._filename, self._dump())
+        self._version = self._file_version()
 
     async def get(self, task_id: str):
-        if self._data is None:
-            await self._load()
+        await self._ensure_loaded()
         return self._data.get(task_id)
 
-    async def store(self, task_id: str, tag: str):
-        if self._data is None:
-            await self._load()
-        self._data[task_id] = tag
-        await self._save()
+    async def store(self, task_id: str, tag: str, owner: str = None):
+        await self._ensure_loaded()
+        async with self._lock, self._file_lock():
+            self._data[task_id] = tag
+            await self._save()
 
     async def remove(self, task_id: str):
-        if self._data is None:
-            await self._load()
-        if task_id in self._data:
-            del self._data[task_id]
-            await self._save()
+        await self._ensure_loaded()
+        async with self._lock, self._file_lock():
+            if task_id in self._data:
+                del self._data[task_id]
+                await self._save()
 
     async def all(self):
-        if self._data is None:
-            await self._load()
+        await self._ensure_loaded()
         return self._data.copy()
+
+    async def has(self, task_id: str) -> bool:
+        await self._ensure_loaded()
+        return task_id in self._data
+
+    async def find_by_tag(self, tag: str) -> list[str]:
+        await self._ensure_loaded()
+        return [
+            task_id
+            for task_id, task_tag in self._data.items()
+            if task_tag == tag
+        ]
+
+    async def close(self):
+        pass
+
+
+class JournalDataManager(DataManager):
+    # The snapshot keeps the plain `task_id:tag` format, every change after it is appended to the journal:
+    #   +task_id:tag
+    #   -task_id
+    # Appends are fsync'ed in batches (group commit), the journal is compacted into the snapshot in background.
+
+    def __init__(self, filename, flush_interval=0.05, flush_batch_size=100, compact_threshold=1000, shared=False):
+        super().__init__(filename, shared=shared)
+        self._journal_filename = f'{filename}.journal'
+        self._flush_interval = flush_interval
+        self._flush_batch_size = flush_batch_size
+        self._compact_threshold = compact_threshold
+        self._journal_records = 0
+        self._pending: list[tuple[str, asyncio.Future]] = []
+        self._flush_event: asyncio.Event | None = None
+        self._flusher: asyncio.Task | None = None
+        self._compactor: asyncio.Task | None = None
+        # serializes journal appends against compaction
+        self._io_lock = asyncio.Lock()
+
+    def _file_version(self) -> tuple:
+        return file_version(self._filename, self._journal_filename)
+
+    async def _load(self):
+        await super()._load()
+        self._journal_records = 0
+        if not await ospath.exists(self._journal_filename):
+            return
+        async with aiofiles.open(self._journal_filename, 'r') as f:
+            lines = await f.readlines()
+        for i, line in enumerate(lines):
+            if not line.endswith('\n'):
+                logger.warning(f'skipping incomplete journal record: {line!r}')
+                if self._shared and not self._file_locked:
+                    # could be an append in progress: only repair under the lock, reload there
+                    self._version = None
+                    break
+                # torn write of the last record: drop it, so the next append starts on a fresh line
+                await asyncio.to_thread(write_atomic, self._journal_filename, ''.join(lines[:i]))
+                self._version = self._file_version()
+                break
+            self._journal_records += 1
+            self._apply(line.rstrip('\n'))
+        logger.debug(f'replayed {self._journal_records} journal records')
+
+    def _apply(self, record: str):
+        if record.startswith('+'):
+            r = parse_line(record[1:])
+            if r:
+                task_id, tag = r
+                self._data[task_id] = tag
+        elif record.startswith('-'):
+            self._data.pop(record[1:], None)
+
+    # the mapping changes once the record is durable (see `_flush`), a failed append leaves it as it was
+
+    async def store(self, task_id: str, tag: str, owner: str = None):
+        await self._ensure_loaded()
+        await self._append(f'+{task_id}:{tag}')
+
+    async def remove(self, task_id: str):
+        await self._ensure_loaded()
+        if task_id in self._data:
+            await self._append(f'-{task_id}')
+
+    async def _append(self, record: str):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((record, future))
+        if self._flusher is None or self._flusher.done():
+            self._flush_event = asyncio.Event()
+            self._flusher = asyncio.create_task(self._flush_loop())
+        if len(self._pending) >= self._flush_batch_size:
+            self._flush_event.set()
+        # returns once the record is durable
+        await future
+
+    async def _flush_loop(self):
+        while self._pending:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            await self._flush()
+
+    async def _flush(self):
+        async with self._lock, self._io_lock:
+            pending, self._pending = self._pending, []
+            if not pending:
+                return
+            try:
+                async with self._file_lock():
+                    text = ''.join(f'{record}\n' for record, _ in pending)
+                    with DATA_MANAGER_LATENCY.time(operation='journal_flush'):
+                        await asyncio.to_thread(self._write_journal, text)
+                    self._version = self._file_version()
+            except Exception as e:
+                for _, future in pending:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            self._journal_records += len(pending)
+            # on top of whatever could have been reloaded under the file lock
+            for record, _ in pending:
+                self._apply(record)
+            for _, future in pending:
+                if not future.done():
+                    future.set_result(None)
+        if self._journal_records >= self._compact_threshold and (self._compactor is None or self._compactor.done()):
+            self._compactor = asyncio.create_task(self.compact())
+
+    def _write_journal(self, text: str):
+        with open(self._journal_filename, 'a') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def compact(self):
+        async with self._lock, self._io_lock, self._file_lock():
+            if self._data is None:
+                return
+            logger.debug(f'compacting {self._journal_records} journal records')
+            with DATA_MANAGER_LATENCY.time(operation='compact'):
+                await asyncio.to_thread(write_atomic, self._filename, self._dump())
+                # everything in the journal is in the snapshot now
+                await asyncio.to_thread(write_atomic, self._journal_filename, '')
+            self._journal_records = 0
+            self._version = self._file_version()
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flush_event.set()
+            await self._flusher
+        if self._compactor is not None:
+            await self._compactor
+
+
+class SQLiteDataManager(DataManager):
+    # `filename` is the text file to migrate from (once), the mapping itself lives in `db_filename`
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS pairs (
+            task_id TEXT PRIMARY KEY,
+            tag TEXT NOT NULL,
+            owner TEXT
+        );
+        CREATE INDEX IF NOT EXISTS pairs_tag ON pairs (tag);
+        CREATE INDEX IF NOT EXISTS pairs_owner ON pairs (owner);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    '''
+
+    def __init__(self, filename, db_filename, shared=False):
+        super().__init__(filename, shared=shared)
+        self._db_filename = db_filename
+        self._connection: sqlite3.Connection | None = None
+        # one connection shared by the worker threads
+        self._db_lock = threading.Lock()
+        # in-memory copy of the tracked ids for the webhook fast path;
+        # without `shared` it only sees the changes made by this process
+        self._task_ids: set[str] = set()
+        # `PRAGMA data_version` the ids were loaded at, it changes on commits of the other connections
+        self._data_version = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            connection = sqlite3.connect(self._db_filename, check_same_thread=False, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(self.SCHEMA)
+            self._connection = connection
+        return self._connection
+
+    def _execute(self, sql: str, parameters=()) -> list[tuple]:
+        with self._db_lock:
+            return self._connect().execute(sql, parameters).fetchall()
+
+    async def _query(self, sql: str, parameters=()) -> list[tuple]:
+        await self._ensure_loaded()
+        with DATA_MANAGER_LATENCY.time(operation='query'):
+            return await asyncio.to_thread(self._execute, sql, parameters)
+
+    def _stale(self) -> bool:
+        # the database itself is shared, only `_task_ids` has to be refreshed (see `has`)
+        return False
+
+    async def _load(self):
+        # nothing is cached in memory, `_data` only marks that the migration check is done
+        migrated = await asyncio.to_thread(self._execute, "SELECT value FROM meta WHERE key = 'migrated_from'")
+        if not migrated:
+            await self._migrate()
+        await asyncio.to_thread(self._load_task_ids)
+        self._data = dict()
+
+    def _load_task_ids(self):
+        with self._db_lock:
+            connection = self._connect()
+            (data_version,), = connection.execute('PRAGMA data_version').fetchall()
+            if data_version == self._data_version:
+                return
+            rows = connection.execute('SELECT task_id FROM pairs').fetchall()
+            self._task_ids = set(task_id for task_id, in rows)
+            self._data_version = data_version
+
+    async def _migrate(self):
+        # the text snapshot (and journal, if there is one) is imported exactly once
+        source = JournalDataManager(self._filename)
+        data = await source.all()
+        await asyncio.to_thread(self._import, data)
+        logger.info(f'migrated {len(data)} pairs from {self._filename} to {self._db_filename}')
+
+    def _import(self, data: dict):
+        with self._db_lock:
+            connection = self._connect()
+            with connection:
+                connection.execute('BEGIN')
+                connection.executemany(
+                    'INSERT OR IGNORE INTO pairs (task_id, tag) VALUES (?, ?)',
+                    list(data.items()),
+                )
+                connection.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated_from', ?)",
+                    (self._filename,),
+                )
+
+    async def get(self, task_id: str):
+        rows = await self._query('SELECT tag FROM pairs WHERE task_id = ?', (task_id,))
+        return rows[0][0] if rows else None
+
+    async def store(self, task_id: str, tag: str, owner: str = None):
+        await self._query(
+            'INSERT INTO pairs (task_id, tag, owner) VALUES (?, ?, ?) '
+            'ON CONFLICT (task_id) DO UPDATE SET tag = excluded.tag, owner = COALESCE(excluded.owner, owner)',
+            (task_id, tag, owner),
+        )
+        self._task_ids.add(task_id)
+
+    async def remove(self, task_id: str):
+        await self._query('DELETE FROM pairs WHERE task_id = ?', (task_id,))
+        self._task_ids.discard(task_id)
+
+    async def has(self, task_id: str) -> bool:
+        await self._ensure_loaded()
+        if self._shared:
+            # picks up the pairs stored by the other processes
+            await asyncio.to_thread(self._load_task_ids)
+        return task_id in self._task_ids
+
+    async def all(self):
+        rows = await self._query('SELECT task_id, tag FROM pairs')
+        return dict(rows)
+
+    async def find_by_tag(self, tag: str) -> list[str]:
+        rows = await self._query('SELECT task_id FROM pairs WHERE tag = ?', (tag,))
+        return [task_id for task_id, in rows]
+
+    async def find_by_owner(self, owner: str) -> dict:
+        # only this backend keeps the owners; pairs migrated from the text file have none until stored again
+        rows = await self._query('SELECT task_id, tag FROM pairs WHERE owner = ?', (owner,))
+        return dict(rows)
+
+    async def close(self):
+        with self._db_lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+def create_data_manager(backend: str, filename: str, compact_threshold=1000, db_filename=None,
+                        shared=False) -> DataManager:
+    if backend == 'file':
+        return DataManager(filename, shared=shared)
+    if backend == 'journal':
+        return JournalDataManager(filename, compact_threshold=compact_threshold, shared=shared)
+    if backend == 'sqlite':
+        return SQLiteDataManager(filename, db_filename, shared=shared)
+    raise ValueError(f'Unknown data backend "{backend}"')
@@ -1,26 +1,111 @@
+import asyncio
 import logging
-from datetime import date
+from datetime import date, timedelta
 from operator import methodcaller
 from typing import List, NamedTuple
 
+import aiofiles
 import aiohttp
+from aiofiles import ospath
 
 __all__ = [
+    'AttributeUpdateBuffer',
     'AttributeValue',
     'ExistioAPI',
+    'ExistioError',
+    'ExistioRequestError',
 ]
 
+import tracing
 import utils
+from cache import MISSING, TTLCache
+from metrics import track_upstream
+from ratelimit import TokenBucket, backoff_delay, parse_retry_after
 
 logger = logging.getLogger(__name__)
 
 
+class ExistioError(Exception):
+    # Exist.io rejected the value, retrying would not help
+    pass
+
+
+class ExistioRequestError(Exception):
+    # the request failed (an error status after the retries), the work should be retried later
+    pass
+
+
 class AttributeValue(NamedTuple):
     name: str
     date: str
     value: int = 1
 
 
+class AttributeUpdateBuffer:
+    # collects values for a short window and sends them as one /attributes/update/ request
+
+    def __init__(self, existio_api: 'ExistioAPI', window: float):
+        self._existio_api = existio_api
+        self._window = window
+        self._pending: dict[tuple[str, str], AttributeValue] = dict()
+        self._waiters: dict[tuple[str, str], list[asyncio.Future]] = dict()
+        self._timer: asyncio.TimerHandle | None = None
+        self._flushes: set[asyncio.Task] = set()
+
+    async def submit(self, item: AttributeValue):
+        key = item.name, item.date
+        # the last write for the same day wins
+        self._pending[key] = item
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(key, []).append(future)
+        if len(self._pending) >= self._existio_api.LIMIT_MAXIMUM_OBJECTS_PER_REQUEST:
+            self._schedule_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self._window, self._schedule_flush)
+        await future
+
+    def _schedule_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, dict()
+        waiters, self._waiters = self._waiters, dict()
+        task = asyncio.create_task(self._flush(pending, waiters))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, pending: dict, waiters: dict):
+        logger.debug(f'flushing {len(pending)} buffered values')
+        try:
+            failed = await self._existio_api.attributes_update(list(pending.values()))
+        except Exception as e:
+            # as is: a timeout or a connection error is not a rejected value, the caller's job is retried
+            for futures in waiters.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+        errors = dict(
+            ((element.get('name'), element.get('date')), element.get('error') or element.get('error_code'))
+            for element in failed
+        )
+        for key, futures in waiters.items():
+            for future in futures:
+                if future.done():
+                    continue
+                if key in errors:
+                    future.set_exception(ExistioError(errors[key]))
+                else:
+                    future.set_result(None)
+
+    async def flush(self):
+        self._schedule_flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+
 class ExistioAPI:
     API_VERSION = 2
     BASE_URL = f'https://exist.io/api/{API_VERSION}/'
@@ -30,21 +115,99 @@ class ExistioAPI:
     LIMIT_MAXIMUM_DAYS = 31
     LIMIT_MAXIMUM_LIMIT = 100
 
+    RETRY_STATUSES = (429, 502, 503, 504)
+    # the request was not processed, so it is safe to retry even a non-idempotent call
+    RETRY_STATUSES_UNPROCESSED = (429,)
+
+    # update failures which mean we no longer own the attribute
+    ACQUIRE_REFRESH_ERROR_CODES = ('not_found', 'not_owner', 'not_acquired')
+
     _token: str
+    _session: aiohttp.ClientSession | None = None
 
-    def __init__(self, token):
+    def __init__(self, token, connection_limit=10, dns_cache_ttl=300, timeout=30,
+                 cache_size=20000, cache_ttl_closed=86400, cache_ttl_current=60, acquired_filename=None,
+                 update_window=0, rate_limit=0, rate_burst=10, max_in_flight=10, max_retries=5, base_url=None,
+                 shared=False):
         self._token = token
+        # e.g. a local stand-in for the benchmarks
+        self._base_url = base_url or self.BASE_URL
+        self._connection_limit = connection_limit
+        self._dns_cache_ttl = dns_cache_ttl
+        self._timeout = timeout
+        # (attribute, date) -> value
+        self._values_cache = TTLCache(cache_size)
+        # with `shared` other processes write the values too and their writes can not invalidate this cache:
+        # the closed days are cached as briefly as the current ones
+        self._cache_ttl_closed = cache_ttl_current if shared else cache_ttl_closed
+        self._cache_ttl_current = cache_ttl_current
+        # attribute -> number of writes, a read which overlapped with a write does not fill the cache
+        self._values_generations: dict[str, int] = dict()
+        # attributes this client is known to own, so updates skip /attributes/acquire/;
+        # a release by another process is noticed by the failed update (ACQUIRE_REFRESH_ERROR_CODES)
+        self._acquired: set[str] = set()
+        self._acquired_filename = acquired_filename
+        self._acquired_lock = asyncio.Lock()
+        # throttling of the outgoing requests
+        self._bucket = TokenBucket(rate_limit, rate_burst)
+        self._max_in_flight = max_in_flight
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._max_retries = max_retries
+        self._waiting = 0
+        self._running = 0
+        self._retries = 0
+        # opt-in write coalescing
+        self._update_buffer = AttributeUpdateBuffer(self, update_window) if update_window > 0 else None
+
+    async def start(self):
+        if self._session is not None and not self._session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self._connection_limit,
+            ttl_dns_cache=self._dns_cache_ttl,
+            keepalive_timeout=60,
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self._timeout),
+            headers=dict(Authorization=f'Bearer {self._token}'),
+        )
+
+    async def close(self):
+        if self._update_buffer is not None:
+            await self._update_buffer.flush()
+        if self._session is None:
+            return
+        await self._session.close()
+        self._session = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
 
-    async def _request(self, method, path, **kwargs):
+    async def _request(self, method, path, idempotent=True, **kwargs):
         method = method.upper()
         path = path.lstrip('/')
-        url = self.BASE_URL + path
-        kwargs.setdefault('headers', dict(Authorization=f'Bearer {self._token}'))
-        logger.debug(f'request {method} {url}')
-        async with aiohttp.ClientSession() as session:
-            async with session.request(method, url, **kwargs) as response:
-                logger.debug(f'status: {response.status}')
-                result = await response.json()
+        url = self._base_url + path
+        if self._session is None or self._session.closed:
+            # lazy start for callers outside of app lifespan / script loop
+            await self.start()
+        self._waiting += 1
+        try:
+            await self._in_flight.acquire()
+        except BaseException:
+            self._waiting -= 1
+            raise
+        self._running += 1
+        try:
+            with tracing.span('existio', method=method, path=path):
+                result = await self._send(method, url, path, idempotent, **kwargs)
+        finally:
+            self._running -= 1
+            self._in_flight.release()
         detail = result.get('detail')
         if detail:
             logger.error(f'error with detail: {detail} in request "{path}"')
@@ -53,6 +216,51 @@ class ExistioAPI:
             logger.error(f'failed: {failed} in request "{path}"')
         return result
 
+    async def _send(self, method, url, path, idempotent: bool, **kwargs) -> dict:
+        # the caller holds an in-flight slot and is still counted as waiting until the first token
+        try:
+            await self._bucket.acquire()
+        finally:
+            self._waiting -= 1
+        retry_statuses = self.RETRY_STATUSES if idempotent else self.RETRY_STATUSES_UNPROCESSED
+        attempt = 0
+        while True:
+            logger.debug(f'request {method} {url}')
+            with track_upstream('existio', path) as call:
+                async with self._session.request(method, url, **kwargs) as response:
+                    call['status'] = response.status
+                    logger.debug(f'status: {response.status}')
+                    if response.status not in retry_statuses or attempt >= self._max_retries:
+                        if not 200 <= response.status < 300:
+                            raise ExistioRequestError(f'{response.status} for {method} {path}: '
+                                                      f'{await response.text()}')
+                        try:
+                            return await response.json(content_type=None)
+                        except ValueError:
+                            raise ExistioRequestError(f'{response.status} for {method} {path}: '
+                                                      f'{await response.text()}')
+                    retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            self._retries += 1
+            if retry_after is None:
+                delay = backoff_delay(attempt)
+                logger.warning(f'status {response.status} for {method} {url}, retry in {delay:.1f}s')
+                await asyncio.sleep(delay)
+            else:
+                # jitter spreads the requests which were told the same moment
+                delay = retry_after + backoff_delay(0)
+                logger.warning(f'status {response.status} for {method} {url}, retry after {delay:.1f}s')
+                self._bucket.pause(delay)
+            await self._bucket.acquire()
+            attempt += 1
+
+    def limiter_info(self) -> dict:
+        return dict(
+            queue_depth=self._waiting,
+            in_flight=self._running,
+            max_in_flight=self._max_in_flight,
+            retries=self._retries,
+        )
+
     async def get(self, path, params=None, **kwargs):
         return await self._request('get', path, params=params, **kwargs)
 
@@ -60,20 +268,96 @@ class ExistioAPI:
         return await self._request('post', path, json=json, **kwargs)
 
     async def attribute_values(self, name, date_min: date, date_max: date) -> dict[date, int]:
-        assert (date_max - date_min).days <= self.LIMIT_MAXIMUM_LIMIT, \
-            f'date_max - date_min must be less than {self.LIMIT_MAXIMUM_LIMIT} days'
+        # every page covers at most LIMIT_MAXIMUM_LIMIT days, so a single request returns all of its values
+        pages = []
+        page_min = date_min
+        while page_min <= date_max:
+            page_max = min(page_min + timedelta(days=self.LIMIT_MAXIMUM_LIMIT - 1), date_max)
+            pages.append((page_min, page_max))
+            page_min = page_max + timedelta(days=1)
+        results = await asyncio.gather(*[
+            self._attribute_values_page(name, page_min, page_max)
+            for page_min, page_max in pages
+        ])
+        values = dict()
+        for result in results:
+            values.update(result)
+        return values
+
+    async def _attribute_values_page(self, name, date_min: date, date_max: date) -> dict[date, int]:
+        days = [
+            date_min + timedelta(days=i)
+            for i in range((date_max - date_min).days + 1)
+        ]
+        values = dict()
+        missing = []
+        for day in days:
+            value = self._values_cache.get((name, day))
+            if value is MISSING:
+                missing.append(day)
+            elif value:
+                values[day] = value
+        if not missing:
+            return values
+
+        # only the span of the missing days goes upstream
+        fetch_min, fetch_max = missing[0], missing[-1]
+        generation = self._values_generations.get(name, 0)
         params = dict(
             attribute=name,
             limit=self.LIMIT_MAXIMUM_LIMIT,
-            date_min=date_min.strftime('%Y-%m-%d'),
-            date_max=date_max.strftime('%Y-%m-%d'),
+            date_min=fetch_min.strftime('%Y-%m-%d'),
+            date_max=fetch_max.strftime('%Y-%m-%d'),
         )
         result = await self.get('/attributes/values/', params=params)
-        return dict(
+        fetched = dict(
             (date.fromisoformat(item['date']), int(item['value']))
             for item in result.get('results') or []
             if item['value'] and item['value'] > 0
         )
+        values = dict(
+            (day, value)
+            for day, value in values.items()
+            if not fetch_min <= day <= fetch_max
+        )
+        values.update(fetched)
+        if 'results' in result and generation == self._values_generations.get(name, 0):
+            closed_before = self.closed_before()
+            for day in days:
+                if fetch_min <= day <= fetch_max:
+                    ttl = self._cache_ttl_closed if day < closed_before else self._cache_ttl_current
+                    self._values_cache.set((name, day), fetched.get(day, 0), ttl)
+        return values
+
+    @staticmethod
+    def closed_before(today: date = None) -> date:
+        # the days before it are final: the previous month is still re-rendered in the first days of a month,
+        # and its last day is "today" till the day slice hour of the 1st (see tasks.py)
+        if today is None:
+            today = date.today()
+        month = (today - timedelta(days=1)).replace(day=1)
+        return (month - timedelta(days=1)).replace(day=1)
+
+    def cache_info(self) -> dict:
+        return self._values_cache.info()
+
+    async def load_acquired(self, names=()):
+        acquired = set(names)
+        if self._acquired_filename and await ospath.exists(self._acquired_filename):
+            async with aiofiles.open(self._acquired_filename, 'r') as f:
+                lines = await f.readlines()
+            acquired.update(filter(None, map(str.strip, lines)))
+        changed = not acquired <= self._acquired
+        self._acquired |= acquired
+        if changed:
+            await self._save_acquired()
+
+    async def _save_acquired(self):
+        if not self._acquired_filename:
+            return
+        async with self._acquired_lock:
+            async with aiofiles.open(self._acquired_filename, 'w') as f:
+                await f.write('\n'.join(sorted(self._acquired)))
 
     async def attributes_acquire(self, names):
         logging.debug(f'acquire {len(names)} tags: {names}')
@@ -84,16 +368,16 @@ class ExistioAPI:
                 for name in chunk
             ])
             failed.extend(result.get('failed') or [])
-        if not failed:
-            return
+        failed_names = set(element['name'] for element in failed)
         create_tags = []
         for element in failed:
             if element['error_code'] == 'not_found':
                 create_tags.append(element['name'])
-        if not create_tags:
-            return
-        logging.debug(f'creating {len(create_tags)} tags: {create_tags}')
-        await self.attributes_create(create_tags)
+        if create_tags:
+            logging.debug(f'creating {len(create_tags)} tags: {create_tags}')
+            failed_names -= set(create_tags) - set(await self.attributes_create(create_tags))
+        self._acquired.update(set(names) - failed_names)
+        await self._save_acquired()
 
     async def attributes_release(self, names):
         logging.debug(f'release {len(names)} tags: {names}')
@@ -102,10 +386,14 @@ class ExistioAPI:
                 dict(name=name)
                 for name in chunk
             ])
+        self._acquired.difference_update(names)
+        await self._save_acquired()
 
-    async def attributes_create(self, names):
+    async def attributes_create(self, names) -> list[str]:
+        failed = []
         for chunk in utils.chunks(names, self.LIMIT_MAXIMUM_OBJECTS_PER_REQUEST):
-            await self.post('/attributes/create/', json=[
+            # a retried create could create the attribute twice
+            result = await self.post('/attributes/create/', idempotent=False, json=[
                 dict(
                     name=name,
                     label=name.replace('_', ' '),
@@ -115,11 +403,48 @@ class ExistioAPI:
                 )
                 for name in chunk
             ])
+            failed.extend(element['name'] for element in result.get('failed') or [])
+        return failed
+
+    async def attributes_update(self, data: List[AttributeValue]) -> list[dict]:
+        names = list(dict.fromkeys(item.name for item in data if item.name not in self._acquired))
+        if names:
+            await self.attributes_acquire(names)
+        failed = await self._attributes_update(data)
+        refresh_names = set(
+            element['name']
+            for element in failed
+            if element.get('error_code') in self.ACQUIRE_REFRESH_ERROR_CODES
+        )
+        if refresh_names:
+            # our knowledge was stale: acquire again and retry only those values
+            logging.debug(f'refreshing {len(refresh_names)} tags: {refresh_names}')
+            self._acquired.difference_update(refresh_names)
+            await self.attributes_acquire(list(refresh_names))
+            failed = [element for element in failed if element.get('name') not in refresh_names]
+            failed.extend(await self._attributes_update([item for item in data if item.name in refresh_names]))
+        # invalidate after the write; a read which started before it may still return the old value,
+        # but the bumped generation keeps that value out of the cache
+        for item in data:
+            self._values_cache.delete((item.name, date.fromisoformat(item.date)))
+        for name in set(item.name for item in data):
+            self._values_generations[name] = self._values_generations.get(name, 0) + 1
+        return failed
 
-    async def attributes_update(self, data: List[AttributeValue]):
-        await self.attributes_acquire([item.name for item in data])
+    async def attribute_update(self, item: AttributeValue):
+        if self._update_buffer is not None:
+            await self._update_buffer.submit(item)
+            return
+        failed = await self.attributes_update([item])
+        if failed:
+            raise ExistioError(failed[0].get('error') or failed[0].get('error_code'))
+
+    async def _attributes_update(self, data: List[AttributeValue]) -> list[dict]:
+        failed = []
         for chunk in utils.chunks(data, self.LIMIT_MAXIMUM_OBJECTS_PER_REQUEST):
-            await self.post('/attributes/update/', json=list(map(methodcaller('_asdict'), chunk)))
+            result = await self.post('/attributes/update/', json=list(map(methodcaller('_asdict'), chunk)))
+            failed.extend(result.get('failed') or [])
+        return failed
 
     @classmethod
     def get_tag_url(cls, tag):
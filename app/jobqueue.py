@@ -0,0 +1,312 @@
+import asyncio
+import logging
+import random
+import sqlite3
+import threading
+import time
+from typing import Awaitable, Callable, NamedTuple
+
+__all__ = [
+    'Job',
+    'JobQueue',
+]
+
+logger = logging.getLogger(__name__)
+
+
+class Job(NamedTuple):
+    id: int
+    key: str
+    event_name: str
+    payload: str
+    attempts: int
+    created_at: float
+
+
+class JobQueue:
+    # Durable SQLite-backed queue drained by a pool of async workers.
+    # Jobs with the same key run strictly one after another, failed jobs are retried with exponential backoff
+    # and moved to `dead_jobs` after `max_attempts`.
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT NOT NULL,
+            event_name TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            available_at REAL NOT NULL,
+            locked_until REAL,
+            last_error TEXT
+        );
+        CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key, id);
+        CREATE INDEX IF NOT EXISTS jobs_available_at ON jobs (available_at);
+        CREATE TABLE IF NOT EXISTS dead_jobs (
+            id INTEGER PRIMARY KEY,
+            key TEXT NOT NULL,
+            event_name TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            attempts INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            failed_at REAL NOT NULL,
+            last_error TEXT
+        );
+        CREATE TABLE IF NOT EXISTS deliveries (
+            key TEXT PRIMARY KEY,
+            seen_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS deliveries_seen_at ON deliveries (seen_at);
+    '''
+
+    POLL_INTERVAL = 1.
+
+    ADMIT_QUEUE = 'queue'
+    ADMIT_SHED = 'shed'
+    ADMIT_REJECT = 'reject'
+
+    # prune the seen deliveries every this many puts
+    DELIVERIES_PRUNE_EVERY = 100
+
+    def __init__(self, filename, workers=4, max_attempts=5, backoff_base=2., backoff_maximum=600., lease=600.,
+                 deliveries_ttl=86400., deliveries_max_size=100000, max_pending=0, overflow_policy='shed',
+                 shared=False):
+        self._filename = filename
+        # several processes drain the same queue
+        self._shared = shared
+        self._workers_count = workers
+        self._max_attempts = max_attempts
+        self._backoff_base = backoff_base
+        self._backoff_maximum = backoff_maximum
+        # a claimed job which is not finished within its lease is considered abandoned
+        self._lease = lease
+        # bounded, time-expiring set of webhook deliveries already queued
+        self._deliveries_ttl = deliveries_ttl
+        self._deliveries_max_size = deliveries_max_size
+        self._puts = 0
+        # backpressure: above `max_pending` waiting jobs the queue is overloaded (0 - never);
+        # the depth is counted per process: with several worker processes each one sees mostly its own puts
+        # (the shared queue is re-counted only while idle), so together they can admit more than `max_pending`
+        self._max_pending = max_pending
+        self._overflow_policy = overflow_policy
+        self._depth = 0
+        self.counters = dict(queued=0, duplicates=0, shed=0, rejected=0)
+        self._connection: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+        self._workers: list[asyncio.Task] = []
+        self._wakeup: asyncio.Event | None = None
+        self._stopping = False
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            connection = sqlite3.connect(self._filename, check_same_thread=False, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(self.SCHEMA)
+            self._connection = connection
+        return self._connection
+
+    def _execute(self, sql: str, parameters=()) -> list[tuple]:
+        with self._lock:
+            return self._connect().execute(sql, parameters).fetchall()
+
+    async def put(self, key: str, event_name: str, payload: str, delivery_key: str = None) -> bool:
+        queued = await asyncio.to_thread(self._put, key, event_name, payload, delivery_key)
+        if not queued:
+            self.counters['duplicates'] += 1
+            return False
+        self._depth += 1
+        self.counters['queued'] += 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return True
+
+    @property
+    def depth(self) -> int:
+        # pending jobs as tracked in memory, without a query
+        return self._depth
+
+    @property
+    def overloaded(self) -> bool:
+        return 0 < self._max_pending <= self._depth
+
+    def admit(self, low_value: bool) -> str:
+        # what to do with a new event: ADMIT_QUEUE it, ADMIT_SHED (drop) it or ADMIT_REJECT it for a redelivery
+        if not self.overloaded:
+            return self.ADMIT_QUEUE
+        if low_value and self._overflow_policy == 'shed':
+            self.counters['shed'] += 1
+            return self.ADMIT_SHED
+        self.counters['rejected'] += 1
+        return self.ADMIT_REJECT
+
+    def shed_low_value(self) -> bool:
+        # low-value work inside of the running jobs (e.g. stats refresh) is deferred while overloaded
+        if self._overflow_policy == 'shed' and self.overloaded:
+            self.counters['shed'] += 1
+            return True
+        return False
+
+    def _put(self, key: str, event_name: str, payload: str, delivery_key: str = None) -> bool:
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            self._puts += 1
+            if delivery_key and self._puts % self.DELIVERIES_PRUNE_EVERY == 0:
+                self._prune_deliveries(connection, now)
+            with connection:
+                connection.execute('BEGIN IMMEDIATE')
+                if delivery_key:
+                    # redelivery of an already queued webhook
+                    row = connection.execute(
+                        'SELECT seen_at FROM deliveries WHERE key = ?', (delivery_key,),
+                    ).fetchone()
+                    if row is not None and row[0] >= now - self._deliveries_ttl:
+                        return False
+                    connection.execute(
+                        'INSERT OR REPLACE INTO deliveries (key, seen_at) VALUES (?, ?)', (delivery_key, now),
+                    )
+                connection.execute(
+                    'INSERT INTO jobs (key, event_name, payload, created_at, available_at) VALUES (?, ?, ?, ?, ?)',
+                    (key, event_name, payload, now, now),
+                )
+        return True
+
+    def _prune_deliveries(self, connection: sqlite3.Connection, now: float):
+        connection.execute('DELETE FROM deliveries WHERE seen_at < ?', (now - self._deliveries_ttl,))
+        connection.execute('''
+            DELETE FROM deliveries WHERE key IN (
+                SELECT key FROM deliveries ORDER BY seen_at DESC LIMIT -1 OFFSET ?
+            )
+        ''', (self._deliveries_max_size,))
+
+    def _claim(self) -> Job | None:
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute('BEGIN IMMEDIATE')
+                # the oldest ready job whose key has no earlier job (running or waiting for a retry)
+                row = connection.execute('''
+                    SELECT id, key, event_name, payload, attempts, created_at FROM jobs AS j
+                    WHERE available_at <= ? AND (locked_until IS NULL OR locked_until < ?)
+                    AND NOT EXISTS (SELECT 1 FROM jobs AS p WHERE p.key = j.key AND p.id < j.id)
+                    ORDER BY id LIMIT 1
+                ''', (now, now)).fetchone()
+                if row is None:
+                    return None
+                connection.execute('UPDATE jobs SET locked_until = ? WHERE id = ?', (now + self._lease, row[0]))
+        return Job(*row)
+
+    def _done(self, job: Job):
+        self._execute('DELETE FROM jobs WHERE id = ?', (job.id,))
+
+    def _failed(self, job: Job, error: str) -> bool:
+        attempts = job.attempts + 1
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.execute('BEGIN IMMEDIATE')
+                if attempts >= self._max_attempts:
+                    connection.execute(
+                        'INSERT INTO dead_jobs (id, key, event_name, payload, attempts, created_at, failed_at, '
+                        'last_error) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        (job.id, job.key, job.event_name, job.payload, attempts, job.created_at, now, error),
+                    )
+                    connection.execute('DELETE FROM jobs WHERE id = ?', (job.id,))
+                    return False
+                delay = min(self._backoff_maximum, self._backoff_base * 2 ** (attempts - 1))
+                delay *= random.uniform(1, 1.25)
+                connection.execute(
+                    'UPDATE jobs SET attempts = ?, available_at = ?, locked_until = NULL, last_error = ? '
+                    'WHERE id = ?',
+                    (attempts, now + delay, error, job.id),
+                )
+                return True
+
+    def _resume(self):
+        # jobs claimed by a previous run of this process
+        self._execute('UPDATE jobs SET locked_until = NULL WHERE locked_until IS NOT NULL')
+
+    def _count(self) -> int:
+        (depth,), = self._execute('SELECT COUNT(*) FROM jobs')
+        return depth
+
+    async def start(self, handler: Callable[[Job], Awaitable]):
+        if not self._shared:
+            # when shared, the claims could be of the other running processes: they are left to expire
+            await asyncio.to_thread(self._resume)
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._workers = [
+            asyncio.create_task(self._work(handler))
+            for _ in range(self._workers_count)
+        ]
+        stats = await self.stats()
+        self._depth = stats['depth']
+        logger.info(f'job queue started with {self._workers_count} workers, {stats["depth"]} pending jobs')
+
+    async def stop(self):
+        # asyncio.wait_for may swallow a cancel which comes together with the wakeup,
+        # the flag still ends the worker loop then
+        self._stopping = True
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    async def _work(self, handler: Callable[[Job], Awaitable]):
+        while not self._stopping:
+            job = await asyncio.to_thread(self._claim)
+            if job is None:
+                if self._shared:
+                    # the other processes put and finish jobs too
+                    self._depth = await asyncio.to_thread(self._count)
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await handler(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                retry = await asyncio.to_thread(self._failed, job, repr(e))
+                if retry:
+                    logger.warning(f'job {job.id} ({job.event_name}) failed, will retry: {e!r}')
+                else:
+                    self._depth -= 1
+                    logger.exception(f'job {job.id} ({job.event_name}) moved to dead jobs')
+            else:
+                await asyncio.to_thread(self._done, job)
+                self._depth -= 1
+            # the next job of the same key may be ready now
+            self._wakeup.set()
+
+    async def stats(self) -> dict:
+        def query():
+            now = time.time()
+            (depth, running, oldest), = self._execute(
+                'SELECT COUNT(*), COUNT(locked_until), MIN(created_at) FROM jobs',
+            )
+            (dead,), = self._execute('SELECT COUNT(*) FROM dead_jobs')
+            (deliveries,), = self._execute('SELECT COUNT(*) FROM deliveries')
+            return dict(
+                depth=depth,
+                running=running,
+                oldest_age=now - oldest if oldest else 0.,
+                dead=dead,
+                deliveries=deliveries,
+                workers=len(self._workers),
+                max_pending=self._max_pending,
+                overloaded=self.overloaded,
+                **self.counters,
+            )
+
+        return await asyncio.to_thread(query)
@@ -0,0 +1,105 @@
+import asyncio
+import fcntl
+import hashlib
+import os
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable
+
+__all__ = [
+    'Debouncer',
+    'KeyedLock',
+]
+
+
+class KeyedLock:
+    # one asyncio.Lock per key, dropped as soon as nobody holds or waits for it;
+    # with `lock_dir` the holder also takes an exclusive `flock` of the key's file there, so the key is
+    # serialized across processes too
+
+    POLL_INTERVAL = .01
+
+    def __init__(self, lock_dir: str = None):
+        self.lock_dir = lock_dir
+        self._locks: dict[str, asyncio.Lock] = dict()
+        self._users: dict[str, int] = dict()
+
+    def __len__(self):
+        return len(self._locks)
+
+    def locked(self, key: str) -> bool:
+        lock = self._locks.get(key)
+        return lock is not None and lock.locked()
+
+    @asynccontextmanager
+    async def __call__(self, key: str):
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._users[key] = self._users.get(key, 0) + 1
+        try:
+            async with lock:
+                if self.lock_dir is None:
+                    yield
+                else:
+                    async with self._file_lock(key):
+                        yield
+        finally:
+            self._users[key] -= 1
+            if not self._users[key]:
+                del self._users[key]
+                del self._locks[key]
+
+    @asynccontextmanager
+    async def _file_lock(self, key: str):
+        os.makedirs(self.lock_dir, exist_ok=True)
+        filename = os.path.join(self.lock_dir, hashlib.sha1(key.encode()).hexdigest())
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # non-blocking attempts: a cancelled waiter must not leave a thread holding the lock
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(self.POLL_INTERVAL)
+            yield
+        finally:
+            os.close(fd)
+
+
+class Debouncer:
+    # runs the last scheduled call per key once no new call came for `delay` seconds
+
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self._pending: dict[str, tuple[asyncio.TimerHandle, Callable, tuple]] = dict()
+        self._running: set[asyncio.Task] = set()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def schedule(self, key: str, func: Callable[..., Awaitable], *args, delay: float = None):
+        self.cancel(key)
+        if delay is None:
+            delay = self.delay
+        handle = asyncio.get_running_loop().call_later(delay, self._fire, key)
+        self._pending[key] = handle, func, args
+
+    def cancel(self, key: str):
+        pending = self._pending.pop(key, None)
+        if pending is not None:
+            pending[0].cancel()
+
+    def _fire(self, key: str):
+        _, func, args = self._pending.pop(key)
+        task = asyncio.create_task(func(*args))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def flush(self):
+        # run everything pending right now, e.g. on shutdown
+        for key in list(self._pending):
+            self._pending[key][0].cancel()
+            self._fire(key)
+        if self._running:
+            await asyncio.gather(*self._running, return_exceptions=True)
@@ -1,22 +1,33 @@
+import asyncio
 import base64
 import hashlib
 import hmac
+import json
 import logging
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager
 from typing import Annotated
 
-from fastapi import FastAPI, HTTPException, status, BackgroundTasks, Header
+from fastapi import FastAPI, HTTPException, status, Header
 from fastapi.exception_handlers import http_exception_handler, request_validation_exception_handler
 from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, ValidationError
 from pydantic.error_wrappers import ErrorWrapper
 from starlette.requests import Request
-from todoist_api_python.api_async import TodoistAPIAsync
+from starlette.responses import JSONResponse, PlainTextResponse
 
+import metrics
 import tasks
 import todoist
+import tracing
 import utils
 from config import ENV
-from data_manager import DataManager
+from data_manager import create_data_manager
 from existio import ExistioAPI
+from jobqueue import Job, JobQueue
+from updater import Progress, Updater
 
 if not ENV['TODOIST_API_KEY']:
     utils.error("TODOIST_API_KEY should not be empty")
@@ -29,13 +40,122 @@ if ENV['DEBUG']:
 else:
     logging.basicConfig(level=logging.INFO, format=logging_format)
 
+todoist_api = todoist.TodoistClient(ENV['TODOIST_API_KEY'], base_url=ENV['TODOIST_BASE_URL'])
+existio_api = ExistioAPI(
+    ENV['EXISTIO_API_KEY'],
+    connection_limit=ENV['EXISTIO_CONNECTION_LIMIT'],
+    dns_cache_ttl=ENV['EXISTIO_DNS_CACHE_TTL'],
+    timeout=ENV['EXISTIO_TIMEOUT'],
+    cache_size=ENV['EXISTIO_CACHE_SIZE'],
+    cache_ttl_closed=ENV['EXISTIO_CACHE_TTL_CLOSED'],
+    cache_ttl_current=ENV['EXISTIO_CACHE_TTL_CURRENT'],
+    acquired_filename=ENV['ACQUIRED_FILENAME'],
+    update_window=ENV['EXISTIO_UPDATE_WINDOW'],
+    rate_limit=ENV['EXISTIO_RATE_LIMIT'],
+    rate_burst=ENV['EXISTIO_RATE_BURST'],
+    max_in_flight=ENV['EXISTIO_MAX_IN_FLIGHT'],
+    max_retries=ENV['EXISTIO_MAX_RETRIES'],
+    base_url=ENV['EXISTIO_BASE_URL'],
+    shared=ENV['SHARED_STATE'],
+)
+tasks.stats_debouncer.delay = ENV['STATS_DEBOUNCE_SECONDS']
+tracing.slow_threshold = ENV['SLOW_JOB_SECONDS']
+data_manager = create_data_manager(
+    ENV['DATA_BACKEND'],
+    ENV['DATA_FILENAME'],
+    compact_threshold=ENV['DATA_COMPACT_THRESHOLD'],
+    db_filename=ENV['DATA_DB_FILENAME'],
+    shared=ENV['SHARED_STATE'],
+)
+if ENV['SHARED_STATE']:
+    tasks.task_locks.lock_dir = ENV['LOCK_DIR']
+
+job_queue = JobQueue(
+    ENV['QUEUE_FILENAME'],
+    workers=ENV['QUEUE_WORKERS'],
+    max_attempts=ENV['QUEUE_MAX_ATTEMPTS'],
+    backoff_base=ENV['QUEUE_BACKOFF_BASE'],
+    deliveries_ttl=ENV['DEDUP_TTL'],
+    deliveries_max_size=ENV['DEDUP_MAX_SIZE'],
+    max_pending=ENV['QUEUE_MAX_PENDING'],
+    overflow_policy=ENV['QUEUE_OVERFLOW_POLICY'],
+    shared=ENV['SHARED_STATE'],
+)
+tasks.shed_stats = job_queue.shed_low_value
+tasks.shed_stats_delay = ENV['QUEUE_RETRY_AFTER']
+
+
+async def queue_stats_refresh(task_id: str):
+    await job_queue.put(task_id, tasks.STATS_REFRESH_EVENT, json.dumps(dict(task_id=task_id)))
+
+
+tasks.retry_stats = queue_stats_refresh
+
+updater = Updater(
+    data_manager,
+    todoist_api,
+    existio_api,
+    run_filename=ENV['UPDATE_ALL_RUN_FILENAME'],
+    fingerprints_filename=ENV['UPDATE_ALL_FINGERPRINTS_FILENAME'],
+    sync_state_filename=ENV['SYNC_STATE_FILENAME'],
+)
+# background admin runs (update_all), the latest ones are kept for their status
+admin_jobs: dict[str, tuple[asyncio.Task, Progress]] = dict()
+ADMIN_JOBS_KEPT = 20
+
+metrics.Gauge('habist_queue_depth', 'Pending jobs in the queue', lambda: job_queue.depth)
+metrics.Gauge('habist_stats_debounce_pending', 'Stats refreshes waiting for the debounce',
+              lambda: len(tasks.stats_debouncer))
+metrics.Gauge('habist_existio_limiter_waiting', 'Exist.io requests waiting for the limiter',
+              lambda: existio_api.limiter_info()['queue_depth'])
+metrics.Gauge('habist_existio_in_flight', 'Exist.io requests in flight',
+              lambda: existio_api.limiter_info()['in_flight'])
+
+
+async def run_job(job: Job):
+    if job.event_name == tasks.STATS_REFRESH_EVENT:
+        with tracing.trace('job', job_id=job.id, attempt=job.attempts + 1, event_name=job.event_name,
+                           task_id=job.key):
+            await tasks.refresh_stats_job(job.key, data_manager, todoist_api, existio_api)
+        return
+    webhook = todoist.Webhook.parse_raw(job.payload)
+    with tracing.trace('job', job_id=job.id, attempt=job.attempts + 1, event_name=webhook.event_name,
+                       event_id=webhook.event_data.id, task_id=job.key):
+        await tasks.dispatch(webhook.event_name, webhook.event_data, data_manager, todoist_api, existio_api)
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    async with existio_api, todoist_api:
+        data = await data_manager.all()
+        await existio_api.load_acquired(data.values())
+        await job_queue.start(run_job)
+        yield
+        for task, _ in admin_jobs.values():
+            task.cancel()
+        await asyncio.gather(*[task for task, _ in admin_jobs.values()], return_exceptions=True)
+        await job_queue.stop()
+        await tasks.stats_debouncer.flush()
+    await data_manager.close()
+
+
 app = FastAPI(
     debug=ENV['DEBUG'],
+    lifespan=lifespan,
 )
 
-todoist_api = TodoistAPIAsync(ENV['TODOIST_API_KEY'])
-existio_api = ExistioAPI(ENV['EXISTIO_API_KEY'])
-data_manager = DataManager(ENV['DATA_FILENAME'])
+
+@app.middleware('http')
+async def webhook_latency(request: Request, call_next):
+    if request.url.path != '/todoist/':
+        return await call_next(request)
+    started = time.perf_counter()
+    try:
+        return await call_next(request)
+    finally:
+        # the handler puts the event name into the request state once it is parsed
+        event_name = getattr(request.state, 'event_name', None) or 'unknown'
+        metrics.WEBHOOK_LATENCY.observe(time.perf_counter() - started, event_name=event_name)
 
 
 @app.get('/')
@@ -43,35 +163,234 @@ async def root():
     return 'Hey there!'
 
 
+def check_authorization(authorization: str):
+    if authorization.lower() != f"token {ENV['ACQUIRED_TAGS_TOKEN']}":
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Incorrect Authorization token header')
+
+
 @app.get('/acquired_tags/')
 async def acquired_tags(
         authorization: Annotated[str, Header()],
 ):
-    if authorization.lower() != f"token {ENV['ACQUIRED_TAGS_TOKEN']}":
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Incorrect Authorization token header')
+    check_authorization(authorization)
     data = await data_manager.all()
     return list(data.values())
 
 
-@app.post('/todoist/')
+@app.get('/existio_cache/')
+async def existio_cache(
+        authorization: Annotated[str, Header()],
+):
+    # kept for the existing callers, /existio_stats/ has the same data and more
+    check_authorization(authorization)
+    return existio_api.cache_info()
+
+
+@app.get('/existio_stats/')
+async def existio_stats(
+        authorization: Annotated[str, Header()],
+):
+    check_authorization(authorization)
+    return dict(
+        cache=existio_api.cache_info(),
+        limiter=existio_api.limiter_info(),
+    )
+
+
+@app.get('/queue/')
+async def queue_stats(
+        authorization: Annotated[str, Header()],
+):
+    check_authorization(authorization)
+    return await job_queue.stats()
+
+
+@app.get('/metrics')
+async def metrics_endpoint(
+        authorization: str = Header(default=''),
+):
+    if ENV['METRICS_TOKEN'] and authorization.lower() != f"token {ENV['METRICS_TOKEN']}":
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Incorrect Authorization token header')
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+def check_admin_authorization(authorization: str):
+    # the admin API is off without ADMIN_TOKEN; the token is compared exactly and in constant time
+    scheme, _, token = authorization.partition(' ')
+    if not ENV['ADMIN_TOKEN'] or scheme.lower() != 'token' \
+            or not hmac.compare_digest(token.encode(), ENV['ADMIN_TOKEN'].encode()):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Incorrect Authorization token header')
+
+
+class UpdateTaskRequest(BaseModel):
+    task_id: str
+    force: bool = False
+    update_months: int | None = None
+
+
+class GenerateDescriptionRequest(BaseModel):
+    task_id: str
+    show_days: int | None = None
+
+
+class UpdateAllRequest(BaseModel):
+    force: bool = False
+    update_months: int | None = None
+    concurrency: int = 10
+    resume: bool = False
+    incremental: bool = False
+
+
+@app.post('/admin/update_task')
+async def admin_update_task(
+        body: UpdateTaskRequest,
+        authorization: str = Header(default=''),
+):
+    check_admin_authorization(authorization)
+    succeed = await updater.update_task(body.task_id, body.force, body.update_months)
+    if succeed is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Task is not tracked')
+    return dict(task_id=body.task_id, succeed=succeed)
+
+
+@app.post('/admin/generate_description')
+async def admin_generate_description(
+        body: GenerateDescriptionRequest,
+        authorization: str = Header(default=''),
+):
+    check_admin_authorization(authorization)
+    description = await updater.update_description(body.task_id, body.show_days)
+    if description is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Task is not tracked')
+    return dict(task_id=body.task_id, description=description)
+
+
+@app.post('/admin/update_all')
+async def admin_update_all(
+        body: UpdateAllRequest,
+        authorization: str = Header(default=''),
+):
+    check_admin_authorization(authorization)
+    running = [job_id for job_id, (task, _) in admin_jobs.items() if not task.done()]
+    if running:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f'update_all {running[0]} is running')
+    job_id = uuid.uuid4().hex
+    progress = Progress(output=logging.info)
+    task = asyncio.create_task(updater.update_all(
+        body.force, body.update_months, concurrency=body.concurrency, resume=body.resume,
+        incremental=body.incremental, progress=progress,
+    ))
+    admin_jobs[job_id] = task, progress
+    for old_job_id in list(admin_jobs)[:-ADMIN_JOBS_KEPT]:
+        if admin_jobs[old_job_id][0].done():
+            del admin_jobs[old_job_id]
+    return dict(job_id=job_id)
+
+
+@app.get('/admin/jobs/{job_id}')
+async def admin_job(
+        job_id: str,
+        authorization: str = Header(default=''),
+):
+    check_admin_authorization(authorization)
+    if job_id not in admin_jobs:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Unknown job')
+    task, progress = admin_jobs[job_id]
+    if not task.done():
+        state, error = 'running', None
+    elif task.cancelled():
+        state, error = 'cancelled', None
+    elif task.exception() is not None:
+        state, error = 'error', repr(task.exception())
+    else:
+        state, error = 'done', None
+    return dict(job_id=job_id, state=state, error=error, progress=progress.as_dict())
+
+
+@app.get('/debug/profile')
+async def debug_profile(seconds: float = 5.):
+    # samples the live event loop (and so the queue workers) while they keep running
+    if not ENV['DEBUG']:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    seconds = min(max(seconds, .1), 60.)
+    stacks = await asyncio.to_thread(tracing.sample_stacks, threading.get_ident(), seconds)
+    return PlainTextResponse(stacks)
+
+
+async def is_noop_event(payload: dict) -> bool:
+    # looks only at the few raw fields the handlers would check first
+    event_name = payload.get('event_name')
+    event_data = payload.get('event_data')
+    if not isinstance(event_data, dict):
+        return False
+    if event_name == 'note:added':
+        content = str(event_data.get('content') or '')
+        return not content.strip().lower().startswith(tasks.PREFIX_COMMAND)
+    if event_name == 'item:updated':
+        description = str(event_data.get('description') or '')
+        return not description.strip().startswith('/')
+    if event_name in ('item:completed', 'item:uncompleted', 'item:deleted'):
+        return not await data_manager.has(str(event_data.get('id')))
+    return False
+
+
+def inline_schema(model: type[BaseModel]) -> dict:
+    # JSON schema of the model with its definitions inlined: openapi_extra can not add components
+    schema = model.schema()
+    definitions = schema.pop('definitions', dict())
+
+    def resolve(node):
+        if isinstance(node, dict):
+            ref = node.get('$ref', '')
+            if ref.startswith('#/definitions/'):
+                return resolve(definitions[ref.rsplit('/', 1)[1]])
+            return dict((key, resolve(value)) for key, value in node.items())
+        if isinstance(node, list):
+            return [resolve(value) for value in node]
+        return node
+
+    return resolve(schema)
+
+
+# the body is parsed by hand (no-op events skip the validation), the docs still show the Webhook model
+@app.post('/todoist/', openapi_extra=dict(requestBody=dict(
+    required=True,
+    content={'application/json': dict(schema=inline_schema(todoist.Webhook))},
+)))
 async def todoist_webhook(
         request: Request,
-        webhook: todoist.Webhook,
-        background_tasks: BackgroundTasks,
         todoist_hmac_sha256: str = Header(default=None, alias='X-Todoist-HMAC-SHA256'),
+        todoist_delivery_id: str = Header(default=None, alias='X-Todoist-Delivery-ID'),
 ):
+    body = await request.body()
     if not ENV['DEBUG']:
         if not todoist_hmac_sha256:
             raise HTTPException(status_code=status.HTTP_451_UNAVAILABLE_FOR_LEGAL_REASONS,
                                 detail='Empty X-Todoist-HMAC-SHA256 header')
         calculated_hmac = base64.b64encode(hmac.new(
             ENV['TODOIST_CLIENT_SECRET'].encode(),
-            msg=await request.body(),
+            msg=body,
             digestmod=hashlib.sha256,
         ).digest()).decode()
         if todoist_hmac_sha256 != calculated_hmac:
             raise HTTPException(status_code=status.HTTP_451_UNAVAILABLE_FOR_LEGAL_REASONS,
                                 detail='Incorrect X-Todoist-HMAC-SHA256 header')
+    try:
+        payload = json.loads(body)
+    except ValueError as e:
+        raise RequestValidationError([ErrorWrapper(e, ('body',))], body=body)
+    if not isinstance(payload, dict):
+        raise RequestValidationError([ErrorWrapper(ValueError('Object expected'), ('body',))], body=payload)
+    if isinstance(payload.get('event_name'), str) and payload['event_name'] in tasks.EVEN_MAP:
+        request.state.event_name = payload['event_name']
+    # most of the events are irrelevant: skip them before the full parsing
+    if await is_noop_event(payload):
+        logging.debug('Todoist.webhook: skipped event_name=%s', payload.get('event_name'))
+        return 'ok'
+    try:
+        webhook = todoist.Webhook.parse_obj(payload)
+    except ValidationError as e:
+        raise RequestValidationError(e.raw_errors, body=payload)
     if webhook.event_name not in tasks.EVEN_MAP:
         raise RequestValidationError([ErrorWrapper(ValueError('Unknown event'), ('body', 'event_name'))])
     owner = (
@@ -83,29 +402,39 @@ async def todoist_webhook(
                  webhook.event_data)
     if not owner:
         return 'Incorrect ownership, but I do not care'
-    background_tasks.add_task(
-        tasks.EVEN_MAP[webhook.event_name],
-        webhook.event_data,
-        data_manager,
-        todoist_api,
-        existio_api,
-    )
+    admit = job_queue.admit(tasks.is_low_value(webhook.event_name, webhook.event_data))
+    if admit == JobQueue.ADMIT_SHED:
+        logging.warning('Todoist.webhook: overloaded, shed event_name=%s', webhook.event_name)
+        return 'shed'
+    if admit == JobQueue.ADMIT_REJECT:
+        # ask Todoist to deliver it later
+        logging.warning('Todoist.webhook: overloaded, rejected event_name=%s', webhook.event_name)
+        return JSONResponse('busy', status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            headers={'Retry-After': str(ENV['QUEUE_RETRY_AFTER'])})
+    # the work itself is done by the queue workers, it survives restarts and is retried on failures
+    # Todoist may deliver the same webhook more than once
+    delivery_key = todoist_delivery_id or hashlib.sha256(body).hexdigest()
+    queued = await job_queue.put(tasks.event_task_id(webhook.event_data), webhook.event_name, body.decode(),
+                                 delivery_key=delivery_key)
+    if not queued:
+        logging.info('Todoist.webhook: duplicate delivery %s', delivery_key)
+        return 'duplicate'
     return 'ok'
 
 
 @app.exception_handler(HTTPException)
 async def custom_http_exception_handler(request: Request, exc: HTTPException):
     logging.warning('%r, headers=%s', exc, exc.headers)
-    if app.debug:
+    if app.debug or request.url.path != '/todoist/':
         return await http_exception_handler(request, exc)
     # we don't want Todoist to retry
-    return 'not ok, but okay'
+    return JSONResponse('not ok, but okay')
 
 
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
     logging.warning('%r, body=%s', exc, exc.body)
-    if app.debug:
+    if app.debug or request.url.path != '/todoist/':
         return await request_validation_exception_handler(request, exc)
     # we don't want Todoist to retry
-    return 'not ok, but okay'
+    return JSONResponse('not ok, but okay')
@@ -0,0 +1,181 @@
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Iterable
+
+__all__ = [
+    'CONTENT_TYPE',
+    'Counter',
+    'DATA_MANAGER_LATENCY',
+    'Gauge',
+    'HANDLER_LATENCY',
+    'Histogram',
+    'REGISTRY',
+    'UPSTREAM_LATENCY',
+    'UPSTREAM_REQUESTS',
+    'WEBHOOK_LATENCY',
+    'render',
+    'track_upstream',
+]
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60.)
+
+# every metric registers itself here on creation
+REGISTRY: list['Metric'] = []
+
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = '') -> str:
+    pairs = [
+        f'{name}="{escape(value)}"'
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(ABC):
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    @abstractmethod
+    def samples(self) -> Iterable[str]:
+        pass
+
+    def render(self) -> str:
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type}',
+            *self.samples(),
+        ]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = dict()
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in list(self._values.items()):
+            yield f'{self.name}{format_labels(self.labelnames, key)} {format_value(value)}'
+
+
+class Gauge(Metric):
+    # the value is computed by the callback only when scraped
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], float | dict[tuple, float]],
+                 labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._callback = callback
+
+    def samples(self):
+        value = self._callback()
+        if isinstance(value, dict):
+            for key, item in value.items():
+                yield f'{self.name}{format_labels(self.labelnames, key)} {format_value(item)}'
+        else:
+            yield f'{self.name} {format_value(value)}'
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self._buckets = tuple(sorted(buckets))
+        # labels -> [bucket counts..., sum, count]
+        self._values: dict[tuple[str, ...], list[float]] = dict()
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        data = self._values.get(key)
+        if data is None:
+            data = self._values[key] = [0] * len(self._buckets) + [0., 0]
+        index = bisect_left(self._buckets, value)
+        if index < len(self._buckets):
+            data[index] += 1
+        data[-2] += value
+        data[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            # the caller may add labels (e.g. status) while inside
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        for key, data in list(self._values.items()):
+            cumulative = 0
+            for bucket, count in zip(self._buckets, data):
+                cumulative += count
+                labels = format_labels(self.labelnames, key, f'le="{format_value(bucket)}"')
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = format_labels(self.labelnames, key, 'le="+Inf"')
+            yield f'{self.name}_bucket{labels} {data[-1]}'
+            yield f'{self.name}_sum{format_labels(self.labelnames, key)} {format_value(data[-2])}'
+            yield f'{self.name}_count{format_labels(self.labelnames, key)} {data[-1]}'
+
+
+def render() -> str:
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+WEBHOOK_LATENCY = Histogram(
+    'habist_webhook_seconds', 'Webhook response latency by event name', ('event_name',),
+)
+HANDLER_LATENCY = Histogram(
+    'habist_handler_seconds', 'Latency of tasks handlers', ('handler', 'status'),
+)
+UPSTREAM_REQUESTS = Counter(
+    'habist_upstream_requests_total', 'Exist.io and Todoist calls', ('upstream', 'endpoint', 'status'),
+)
+UPSTREAM_LATENCY = Histogram(
+    'habist_upstream_seconds', 'Exist.io and Todoist call latency', ('upstream', 'endpoint'),
+)
+DATA_MANAGER_LATENCY = Histogram(
+    'habist_data_manager_seconds', 'DataManager storage operations', ('operation',),
+)
+
+
+@contextmanager
+def track_upstream(upstream: str, endpoint: str):
+    # the caller sets `status` on the yielded dict once it is known
+    result = dict(status='error')
+    started = time.perf_counter()
+    try:
+        yield result
+    finally:
+        UPSTREAM_LATENCY.observe(time.perf_counter() - started, upstream=upstream, endpoint=endpoint)
+        UPSTREAM_REQUESTS.inc(upstream=upstream, endpoint=endpoint, status=result['status'])
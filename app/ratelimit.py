@@ -0,0 +1,69 @@
+import asyncio
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+__all__ = [
+    'TokenBucket',
+    'backoff_delay',
+    'parse_retry_after',
+]
+
+
+class TokenBucket:
+    # `rate` tokens per second, at most `burst` saved up; rate <= 0 disables limiting
+
+    def __init__(self, rate: float, burst: int):
+        self._rate = rate
+        self._burst = max(burst, 1)
+        self._tokens = float(self._burst)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+        self._paused_till = 0.
+
+    def pause(self, seconds: float):
+        # upstream told us to back off: nobody gets a token until then
+        self._paused_till = max(self._paused_till, time.monotonic() + seconds)
+        self._tokens = 0.
+
+    async def acquire(self):
+        if self._rate <= 0 and not self._paused_till:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_till:
+                    await asyncio.sleep(self._paused_till - now)
+                    continue
+                # the pause is over: back to the lock-free path for an unlimited rate
+                self._paused_till = 0.
+                if self._rate <= 0:
+                    return
+                self._tokens = min(self._burst, self._tokens + (now - self._updated_at) * self._rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+
+
+def backoff_delay(attempt: int, base: float = 1., maximum: float = 60.) -> float:
+    # exponential backoff with full jitter
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.)
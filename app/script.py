@@ -1,14 +1,22 @@
 import asyncio
+import functools
 import logging
-from argparse import ArgumentParser
+import signal
+import sys
+import time
+from argparse import ArgumentParser, Namespace
+from datetime import datetime, time as dt_time, timedelta
 
-from todoist_api_python.api_async import TodoistAPIAsync
+import aiohttp
 
 import tasks
+import tracing
 import utils
 from config import ENV
-from data_manager import DataManager
+from data_manager import create_data_manager
 from existio import ExistioAPI
+from todoist import SyncState, TodoistClient
+from updater import Progress, Updater
 
 if not ENV['TODOIST_API_KEY']:
     utils.error("TODOIST_API_KEY should not be empty")
@@ -21,72 +29,209 @@ if ENV['DEBUG']:
 else:
     logging.basicConfig(format=logging_format)
 
-todoist_api = TodoistAPIAsync(ENV['TODOIST_API_KEY'])
-existio_api = ExistioAPI(ENV['EXISTIO_API_KEY'])
-data_manager = DataManager(ENV['DATA_FILENAME'])
-
-
-async def update_task_stats(task_id, tag, update_months: int):
-    try:
-        logging.info(f'starting {task_id = }, {tag = }')
-        texts = await tasks.post_stats(task_id, tag, todoist_api, existio_api, update_months=update_months, force=False)
-        logging.info(f'finished {task_id = }, {tag = }')
-    except Exception as e:
-        logging.warning(f'FAILURE: {task_id = }, {tag = }')
-        if ENV['DEBUG']:
-            raise
-        logging.error(e)
-    else:
-        logging.info(f'SUCCESS: {task_id = }, {tag = }')
-        logging.debug('Stats:\n%s\n', '--\n'.join(texts))
+todoist_api = TodoistClient(ENV['TODOIST_API_KEY'], base_url=ENV['TODOIST_BASE_URL'])
+tracing.slow_threshold = ENV['SLOW_JOB_SECONDS']
+
+
+def new_existio_api(shared: bool):
+    return ExistioAPI(
+        ENV['EXISTIO_API_KEY'],
+        connection_limit=ENV['EXISTIO_CONNECTION_LIMIT'],
+        dns_cache_ttl=ENV['EXISTIO_DNS_CACHE_TTL'],
+        timeout=ENV['EXISTIO_TIMEOUT'],
+        cache_size=ENV['EXISTIO_CACHE_SIZE'],
+        cache_ttl_closed=ENV['EXISTIO_CACHE_TTL_CLOSED'],
+        cache_ttl_current=ENV['EXISTIO_CACHE_TTL_CURRENT'],
+        acquired_filename=ENV['ACQUIRED_FILENAME'],
+        update_window=ENV['EXISTIO_UPDATE_WINDOW'],
+        rate_limit=ENV['EXISTIO_RATE_LIMIT'],
+        rate_burst=ENV['EXISTIO_RATE_BURST'],
+        max_in_flight=ENV['EXISTIO_MAX_IN_FLIGHT'],
+        max_retries=ENV['EXISTIO_MAX_RETRIES'],
+        base_url=ENV['EXISTIO_BASE_URL'],
+        shared=shared,
+    )
+
+
+def new_data_manager(shared: bool):
+    return create_data_manager(
+        ENV['DATA_BACKEND'],
+        ENV['DATA_FILENAME'],
+        compact_threshold=ENV['DATA_COMPACT_THRESHOLD'],
+        db_filename=ENV['DATA_DB_FILENAME'],
+        shared=shared,
+    )
+
+
+existio_api = new_existio_api(ENV['SHARED_STATE'])
+data_manager = new_data_manager(ENV['SHARED_STATE'])
+updater = Updater(
+    data_manager,
+    todoist_api,
+    existio_api,
+    run_filename=ENV['UPDATE_ALL_RUN_FILENAME'],
+    fingerprints_filename=ENV['UPDATE_ALL_FINGERPRINTS_FILENAME'],
+    sync_state_filename=ENV['SYNC_STATE_FILENAME'],
+    raise_errors=ENV['DEBUG'],
+)
+if ENV['SHARED_STATE']:
+    tasks.task_locks.lock_dir = ENV['LOCK_DIR']
+
+
+async def run(coro):
+    # pooled upstream sessions for the whole event loop
+    async with existio_api, todoist_api:
+        data = await data_manager.all()
+        await existio_api.load_acquired(data.values())
+        try:
+            return await coro
+        finally:
+            await data_manager.close()
 
 
 async def process_one_task(task_id: str, force: bool, update_months: int):
-    data = await data_manager.all()
-    tag = data[task_id]
-    if force:
-        await tasks.delete_relevant_comment(task_id, todoist_api, include_exist_url=False)
-    await update_task_stats(task_id, tag, update_months)
-    return 'ok'
+    succeed = await updater.update_task(task_id, force, update_months)
+    if succeed is None:
+        utils.error(f'Task {task_id} is not tracked')
+    return 'ok' if succeed else 'failed'
 
 
 async def process_task_description(task_id: str, show_days: int):
-    data = await data_manager.all()
-    tag = data[task_id]
-    description = await tasks.generate_description(tag, existio_api, show_days=show_days)
-    await todoist_api.update_task(task_id, description=description)
+    description = await updater.update_description(task_id, show_days)
+    if description is None:
+        utils.error(f'Task {task_id} is not tracked')
     print(description)
     return 'ok'
 
 
-async def process_all_tasks(force: bool, update_months: int):
-    data = await data_manager.all()
-    if force:
-        # delete all relevant comments first
-        await asyncio.gather(*[
-            tasks.delete_relevant_comment(task_id, todoist_api, include_exist_url=False)
-            for task_id in data.keys()
-        ])
-    await asyncio.gather(*[
-        update_task_stats(task_id, tag, update_months)
-        for task_id, tag in data.items()
-    ])
+async def process_all_tasks(force: bool, update_months: int, concurrency: int = 10, resume=False,
+                            incremental=False, spread: float = 0, sync_state: SyncState = None,
+                            run_filename: str = None) -> list[str]:
+    progress = await updater.update_all(force, update_months, concurrency=concurrency, resume=resume,
+                                        incremental=incremental, spread=spread, sync_state=sync_state,
+                                        progress=Progress(output=functools.partial(print, flush=True)),
+                                        run_filename=run_filename)
+    return [task_id for task_id, _ in progress.failed]
+
+
+def next_day_boundary(now: datetime) -> datetime:
+    # the rendered "today" (tasks.local_today) changes at DAY_SLICE_HOUR
+    boundaries = [
+        datetime.combine(now.date() + timedelta(days=days), dt_time(tasks.DAY_SLICE_HOUR))
+        for days in (0, 1)
+    ]
+    return min(boundary for boundary in boundaries if boundary > now)
+
+
+async def daemon(interval: float, concurrency: int, update_months: int):
+    # Long-running update_all: warm upstream sessions, caches and Sync API state.
+    # Runs right away, then at every day boundary and every `interval` seconds in between,
+    # only the tasks with changed values are updated and their updates are spread over the interval.
+    # The checkpoint file is its own, a run from cron or the admin API keeps theirs.
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+    sync_state = SyncState(todoist_api, filename=ENV['SYNC_STATE_FILENAME'])
+    while not stopping.is_set():
+        started = time.monotonic()
+        boundary = next_day_boundary(datetime.now())
+        print(f'daemon: update started, next day boundary at {boundary}', flush=True)
+        try:
+            await process_all_tasks(False, update_months, concurrency=concurrency, incremental=True,
+                                    spread=interval / 2, sync_state=sync_state,
+                                    run_filename=ENV['DAEMON_RUN_FILENAME'])
+        except Exception:
+            logging.exception('daemon: update failed')
+        timeout = min(
+            max(0., interval - (time.monotonic() - started)),
+            max(0., (boundary - datetime.now()).total_seconds()),
+        )
+        try:
+            await asyncio.wait_for(stopping.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+    print('daemon: stopped', flush=True)
     return 'ok'
 
 
+async def remote(args: Namespace):
+    # thin client of the admin API: the work is done by the running app with its warm clients
+    if not ENV['ADMIN_TOKEN']:
+        utils.error('ADMIN_TOKEN should not be empty')
+    headers = dict(Authorization=f"Token {ENV['ADMIN_TOKEN']}")
+    base_url = ENV['ADMIN_URL'].rstrip('/')
+    async with aiohttp.ClientSession(base_url, headers=headers) as session:
+        async def call(method: str, path: str, **kwargs) -> dict:
+            async with session.request(method, path, **kwargs) as response:
+                data = await response.json(content_type=None)
+                if response.status != 200:
+                    utils.error(f'{response.status}: {data}')
+                return data
+
+        if args.action == 'update_task':
+            data = await call('post', '/admin/update_task', json=dict(
+                task_id=args.task_id, force=args.force, update_months=args.update_months,
+            ))
+            return 'ok' if data['succeed'] else 'failed'
+        if args.action == 'generate_description':
+            data = await call('post', '/admin/generate_description', json=dict(
+                task_id=args.task_id, show_days=args.show_days,
+            ))
+            print(data['description'])
+            return 'ok'
+        if args.action == 'update_all':
+            data = await call('post', '/admin/update_all', json=dict(
+                force=args.force, update_months=args.update_months, concurrency=args.concurrency,
+                resume=args.resume, incremental=args.incremental,
+            ))
+            job_id = data['job_id']
+            print(f'update_all job {job_id} started', flush=True)
+            while True:
+                await asyncio.sleep(ENV['ADMIN_POLL_INTERVAL'])
+                data = await call('get', f'/admin/jobs/{job_id}')
+                progress = data['progress']
+                print(f"[{progress['done']}/{progress['total']}] {progress['rate']:.2f} tasks/s, "
+                      f"ETA {progress['eta']:.0f}s", flush=True)
+                if data['state'] != 'running':
+                    break
+            print(f"update_all {data['state']}: {progress['done'] - progress['unchanged'] - len(progress['failed'])} "
+                  f"of {progress['total']} tasks updated in {progress['elapsed']:.1f}s, "
+                  f"{progress['unchanged']} unchanged, {len(progress['failed'])} failed")
+            for task_id in progress['failed']:
+                print(f'  FAILED: {task_id}')
+            if data['error']:
+                utils.error(data['error'])
+            return progress['failed']
+        utils.error(f'{args.action} can not be run remotely')
+
+
 def main():
     parser = ArgumentParser()
     parser.add_argument('action', help='Which action to perform', choices=[
         'update_all',
         'update_task',
         'generate_description',
+        'daemon',
     ])
+    parser.add_argument('--remote', '-r', action='store_true',
+                        help='Let the running app do it through its admin API (ADMIN_URL, ADMIN_TOKEN)')
     known_args = parser.parse_known_args()[0]
     if known_args.action == 'generate_description':
         parser.add_argument('task_id', help='Selected task')
         parser.add_argument('--show-days', '-d', type=int, help='How many days to show in task\'s description')
+    elif known_args.action == 'daemon':
+        parser.add_argument('--interval', type=float, default=ENV['DAEMON_INTERVAL'],
+                            help='Seconds between the updates')
+        parser.add_argument('--concurrency', '-c', type=int, default=10, help='How many tasks to update at once')
+        parser.add_argument('--update-months', '-m', type=int, help='How many months to process')
     else:
         parser.add_argument('--force', action='store_true', help='Force update all months')
+        if known_args.action == 'update_all':
+            parser.add_argument('--concurrency', '-c', type=int, default=10, help='How many tasks to update at once')
+            parser.add_argument('--resume', action='store_true', help='Skip tasks finished by the previous run')
+            parser.add_argument('--incremental', '-i', action='store_true',
+                                help='Update only tasks whose Exist.io values changed since the last run')
         known_args = parser.parse_known_args()[0]
 
         parser.add_argument('--update-months', '-m', type=int, help='How many months to process',
@@ -95,13 +240,30 @@ def main():
             parser.add_argument('task_id', help='Selected task')
     args = parser.parse_args()
 
-    if args.action == 'update_all':
-        # This will start update in parallel (10x speed increase)
-        asyncio.run(process_all_tasks(args.force, args.update_months))
+    if args.remote:
+        result = asyncio.run(remote(args))
+        if result == 'failed' or isinstance(result, list) and result:
+            sys.exit(1)
+    elif args.action == 'update_all':
+        # a bounded pool of parallel updates
+        failed = asyncio.run(run(process_all_tasks(args.force, args.update_months, concurrency=args.concurrency,
+                                                   resume=args.resume, incremental=args.incremental)))
+        if failed:
+            sys.exit(1)
     elif args.action == 'update_task':
-        asyncio.run(process_one_task(args.task_id, args.force, args.update_months))
+        # the same exit status as with --remote
+        if asyncio.run(run(process_one_task(args.task_id, args.force, args.update_months))) == 'failed':
+            sys.exit(1)
     elif args.action == 'generate_description':
-        asyncio.run(process_task_description(args.task_id, args.show_days))
+        asyncio.run(run(process_task_description(args.task_id, args.show_days)))
+    elif args.action == 'daemon':
+        # the app runs next to it: reload the mapping whenever the files change, do not keep Exist.io values
+        # the app could overwrite, and wait for the app's jobs of a task
+        global existio_api, data_manager
+        existio_api = updater.existio_api = new_existio_api(shared=True)
+        data_manager = updater.data_manager = new_data_manager(shared=True)
+        tasks.task_locks.lock_dir = ENV['LOCK_DIR']
+        asyncio.run(run(daemon(args.interval, args.concurrency, args.update_months)))
 
 
 if __name__ == '__main__':
@@ -1,11 +1,18 @@
+import hashlib
+import logging
 from datetime import datetime, timedelta, date
+from typing import Awaitable, Callable
 
-from todoist_api_python.api_async import TodoistAPIAsync
+import requests
+from todoist_api_python.models import Comment as ApiComment
 
+import tracing
 import utils
 from data_manager import DataManager
-from existio import ExistioAPI, AttributeValue
-from todoist import Comment, Task
+from existio import ExistioAPI, AttributeValue, ExistioError
+from locks import Debouncer, KeyedLock
+from metrics import HANDLER_LATENCY
+from todoist import Comment, SyncCommands, Task, TodoistClient, TodoistSyncError
 
 EMOJI_STATS = '📊'
 EMOJI_EMPTY = '⬜'
@@ -33,6 +40,10 @@ PREFIX_COMMAND = 'existio:'  # This is being interpreted as a command
 EXIST_PART_URL = '/exist.io/'
 
 
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.strip().encode()).hexdigest()
+
+
 def local_now():
     now = datetime.now()
     if now.hour < DAY_SLICE_HOUR:
@@ -40,6 +51,11 @@ def local_now():
     return now
 
 
+def local_today() -> date:
+    # the day the completions count for, the stats render up to it
+    return local_now().date()
+
+
 def current_date():
     return utils.format_date(local_now())
 
@@ -64,13 +80,14 @@ def generate_stats_summary(succeed: int, failed: int, unknown: int = None):
     )
 
 
-async def generate_stats(tag, month: date, existio_api: ExistioAPI) -> (int, str):
+async def generate_stats(tag, month: date, existio_api: ExistioAPI, values: dict[date, int] = None) -> (int, str):
     assert month.day == 1
     month_end = month + timedelta(days=31)
     month_end -= timedelta(days=month_end.day)
-    today = date.today()
+    today = local_today()
 
-    values = await existio_api.attribute_values(tag, date_min=month, date_max=month_end)
+    if values is None:
+        values = await existio_api.attribute_values(tag, date_min=month, date_max=month_end)
     succeed = failed = unknown = 0
     # empty days in the beginning of the month for the offset
     calendar = month.weekday() * EMOJI_EMPTY
@@ -99,11 +116,17 @@ async def generate_stats(tag, month: date, existio_api: ExistioAPI) -> (int, str
     return succeed, f'{header}\n{summary}\n{calendar}'
 
 
-async def generate_description(tag, existio_api: ExistioAPI, show_days: int = None) -> str:
-    today = date_min = date.today()
-    date_min -= timedelta(days=show_days or SHOW_DAYS_IN_DESCRIPTION)
+def description_date_min(show_days: int = None) -> date:
+    return local_today() - timedelta(days=show_days or SHOW_DAYS_IN_DESCRIPTION)
+
+
+async def generate_description(tag, existio_api: ExistioAPI, show_days: int = None,
+                               values: dict[date, int] = None) -> str:
+    today = local_today()
+    date_min = description_date_min(show_days)
 
-    values = await existio_api.attribute_values(tag, date_min=date_min, date_max=today)
+    if values is None:
+        values = await existio_api.attribute_values(tag, date_min=date_min, date_max=today)
     description = ''
     curr_date = today
     while curr_date >= date_min:
@@ -117,14 +140,12 @@ async def generate_description(tag, existio_api: ExistioAPI, show_days: int = No
     return description
 
 
-async def post_stats(task_id: str, tag: str, todoist_api: TodoistAPIAsync, existio_api: ExistioAPI,
-                     update_months: int = None, force=True):
+def stats_months(update_months: int = None) -> list[date]:
+    # first days of the months post_stats renders, oldest first
     if update_months is None:
         update_months = PREVIOUS_MONTHS_STATS
-    today = date.today()
+    today = local_today()
     current_month = today - timedelta(days=today.day - 1)
-    previous_month = current_month - timedelta(days=1)
-    previous_month -= timedelta(days=previous_month.day - 1)
     months = [
         current_month - timedelta(days=30 * i)
         for i in range(update_months + 1)
@@ -134,51 +155,199 @@ async def post_stats(task_id: str, tag: str, todoist_api: TodoistAPIAsync, exist
         month - timedelta(days=month.day - 1)
         for month in months
     ]
-    months = list(reversed(months))
+    return list(reversed(months))
+
+
+def stats_date_min(update_months: int = None) -> date:
+    # the earliest day post_stats could render
+    return min(description_date_min(), stats_months(update_months)[0])
+
+
+def values_fingerprint(tag: str, values: dict[date, int], date_min: date, texts: list[str] = ()) -> str:
+    # changes when any rendered day flips or the rendered "today" moves;
+    # `texts` - the stats comments and the description in Todoist, a deleted or edited one changes it too
+    today = local_today()
+    bitmap = ''.join(
+        '1' if values.get(date_min + timedelta(days=i)) else '0'
+        for i in range((today - date_min).days + 1)
+    )
+    posted = ','.join(sorted(content_hash(text) for text in texts))
+    return content_hash(f'{tag}|{today.isoformat()}|{date_min.isoformat()}|{bitmap}|{posted}')
+
+
+def posted_stats_texts(comments: list[ApiComment], description: str | None, update_months: int = None) -> list[str]:
+    # what post_stats returns, as found in Todoist: the stats comments of the months and the description
+    headers = [generate_stats_header(month) for month in stats_months(update_months)]
+    texts = [
+        comment.content
+        for comment in comments
+        if utils.string_contains(comment.content, *headers)
+    ]
+    texts.append(description or '')
+    return texts
+
+
+async def post_stats(task_id: str, tag: str, todoist_api: TodoistClient, existio_api: ExistioAPI,
+                     update_months: int = None, force=True, comments: list[ApiComment] = None,
+                     values: dict[date, int] = None, current_description: str = None):
+    # `values` must cover stats_date_min(update_months) till today, they are fetched when not given;
+    # `current_description` is the task's description read right before (e.g. the Sync API state of update_all),
+    # an unchanged one is not sent again; never a webhook's copy, earlier jobs of the task could have changed it;
+    # returns the texts of the stats comments and of the description as they are left in Todoist
+    tracing.annotate(tag=tag)
+    today = local_today()
+    current_month = today - timedelta(days=today.day - 1)
+    previous_month = current_month - timedelta(days=1)
+    previous_month -= timedelta(days=previous_month.day - 1)
+    months = stats_months(update_months)
     # print(f'{months = }')
     generate_months = []
     delete_comment_ids = []
-    comments = await todoist_api.get_comments(task_id=task_id)
+    # existing stats comment of each month, indexed by its header
+    stats_comments: dict[date, ApiComment] = dict()
+    if comments is None:
+        comments = await todoist_api.get_comments(task_id=task_id)
     for month in months:
         need_update = month == current_month \
                       or month == previous_month and today.day < DAY_TILL_UPDATE_PREVIOUS_MONTH
         header = generate_stats_header(month)
-        if need_update:
-            for comment in comments:
-                if utils.string_contains(comment.content, header):
-                    delete_comment_ids.append(comment.id)
-            generate_months.append(month)
-        else:
-            for comment in comments:
-                if utils.string_contains(comment.content, header):
-                    break
+        for comment in comments:
+            if not utils.string_contains(comment.content, header):
+                continue
+            if month in stats_comments:
+                # duplicates left by earlier runs
+                delete_comment_ids.append(comment.id)
             else:
-                # if such month does not exist
-                generate_months.append(month)
+                stats_comments[month] = comment
+        if need_update or month not in stats_comments:
+            generate_months.append(month)
     # print(f'{delete_comment_ids = }')
     # print(f'{generate_months = }')
+    # all writes go upstream as a single Sync API batch
+    commands = todoist_api.commands()
     for comment_id in delete_comment_ids:
-        await todoist_api.delete_comment(comment_id)
+        commands.note_delete(comment_id)
+    # fetch the whole span once: every calendar and the description render from it
+    if values is None:
+        date_min = description_date_min()
+        if generate_months:
+            date_min = min(date_min, generate_months[0])
+        values = await existio_api.attribute_values(tag, date_min=date_min, date_max=today)
     texts = []
-    for month in generate_months:
-        succeed, text = await generate_stats(tag, month, existio_api)
-        if succeed:
-            force = True
-        elif not force:
-            # skip months with no successful values
-            continue
-        await todoist_api.add_comment(text, task_id=task_id)
-        texts.append(text)
-    description = await generate_description(tag, existio_api)
+    with tracing.span('render', months=len(generate_months)):
+        for month in generate_months:
+            succeed, text = await generate_stats(tag, month, existio_api, values=values)
+            comment = stats_comments.get(month)
+            if succeed:
+                force = True
+            elif not force and comment is None:
+                # skip months with no successful values
+                continue
+            if comment is None:
+                commands.note_add(task_id, text)
+            elif content_hash(comment.content) != content_hash(text):
+                commands.note_update(comment.id, text)
+            texts.append(text)
+        texts.extend(
+            comment.content
+            for month, comment in stats_comments.items()
+            if month not in generate_months
+        )
+        description = await generate_description(tag, existio_api, values=values)
     texts.append(description)
-    await todoist_api.update_task(task_id, description=description)
+    if current_description is None or current_description.strip() != description:
+        commands.item_update(task_id, description=description)
+    await commit_commands(commands)
     return texts
 
 
+async def refresh_stats(
+        task_id: str,
+        data_manager: DataManager,
+        todoist_api: TodoistClient,
+        existio_api: ExistioAPI,
+):
+    # Exist.io writes happen right away, the stats refresh waits for the burst of events to settle
+    if shed_stats():
+        # deferred, not dropped: one pending refresh per task, coalesced with the next events of the task
+        logging.info(f'overloaded, stats refresh is deferred: {task_id = }')
+        stats_debouncer.schedule(task_id, post_deferred_stats, task_id, data_manager, todoist_api, existio_api,
+                                 delay=shed_stats_delay)
+        return
+    if stats_debouncer.delay <= 0:
+        await post_current_stats(task_id, data_manager, todoist_api, existio_api)
+        return
+    stats_debouncer.schedule(task_id, post_debounced_stats, task_id, data_manager, todoist_api, existio_api)
+
+
+async def post_current_stats(
+        task_id: str,
+        data_manager: DataManager,
+        todoist_api: TodoistClient,
+        existio_api: ExistioAPI,
+):
+    # the tag is read at the moment of posting, it could have been changed or released meanwhile
+    tag = await data_manager.get(task_id)
+    if tag:
+        # the description the webhook came with could be outdated by the earlier jobs of the task,
+        # so item_update is always sent
+        await post_stats(task_id, tag, todoist_api, existio_api)
+
+
+async def post_debounced_stats(
+        task_id: str,
+        data_manager: DataManager,
+        todoist_api: TodoistClient,
+        existio_api: ExistioAPI,
+):
+    try:
+        with tracing.trace('debounced_stats', task_id=task_id):
+            await refresh_stats_job(task_id, data_manager, todoist_api, existio_api)
+    except Exception:
+        if retry_stats is None:
+            logging.exception(f'debounced stats refresh failed: {task_id = }')
+            return
+        # nobody awaits the debounced call: hand it over to the job queue and its retries
+        logging.warning(f'debounced stats refresh failed, queued for a retry: {task_id = }', exc_info=True)
+        try:
+            await retry_stats(task_id)
+        except Exception:
+            logging.exception(f'stats refresh retry could not be queued: {task_id = }')
+
+
+async def post_deferred_stats(
+        task_id: str,
+        data_manager: DataManager,
+        todoist_api: TodoistClient,
+        existio_api: ExistioAPI,
+):
+    # a refresh deferred by the load shedding
+    if retry_stats is not None and shed_stats():
+        # still overloaded: the job queue keeps it until the jobs before it are done
+        logging.info(f'still overloaded, stats refresh is queued: {task_id = }')
+        try:
+            await retry_stats(task_id)
+        except Exception:
+            logging.exception(f'stats refresh could not be queued: {task_id = }')
+        return
+    await post_debounced_stats(task_id, data_manager, todoist_api, existio_api)
+
+
+async def refresh_stats_job(
+        task_id: str,
+        data_manager: DataManager,
+        todoist_api: TodoistClient,
+        existio_api: ExistioAPI,
+):
+    # the stats refresh on its own: a debounced call or a STATS_REFRESH_EVENT job, errors are raised
+    async with task_locks(task_id):
+        await post_current_stats(task_id, data_manager, todoist_api, existio_api)
+
+
 async def comment_added(
         comment: Comment,
         data_manager: DataManager,
-        todoist_api: TodoistAPIAsync,
+        todoist_api: TodoistClient,
         existio_api: ExistioAPI,
 ):
     text = comment.content.strip().lower()
@@ -187,7 +356,8 @@ async def comment_added(
     comment_id = comment.id
     task_id = comment.item_id
     command = text[len(PREFIX_COMMAND):].strip()
-    await process_command(command, task_id, comment_id, data_manager, todoist_api, existio_api)
+    await process_command(command, task_id, comment_id, data_manager, todoist_api, existio_api,
+                          owner=comment.item.user_id)
 
 
 async def process_command(
@@ -195,8 +365,9 @@ async def process_command(
         task_id: str,
         comment_id: str | None,
         data_manager: DataManager,
-        todoist_api: TodoistAPIAsync,
+        todoist_api: TodoistClient,
         existio_api: ExistioAPI,
+        owner: str = None,
 ):
     if command == 'release':
         await release_tag(task_id, data_manager, todoist_api, existio_api)
@@ -204,13 +375,15 @@ async def process_command(
     elif command == 'update':
         tag = await data_manager.get(task_id)
         if tag:
+            # not debounced: the stats are re-posted (or the job fails and is retried) right after the delete
             await delete_relevant_comment(task_id, todoist_api, include_exist_url=False)
-            await post_stats(task_id, tag, todoist_api, existio_api)
+            await post_current_stats(task_id, data_manager, todoist_api, existio_api)
         return
     elif command == 'yesterday' or command.startswith(('on:', 'off:')):
         if comment_id:
-            await todoist_api.delete_comment(comment_id)
+            await delete_comment_if_exists(comment_id, todoist_api)
         tag = await data_manager.get(task_id)
+        tracing.annotate(tag=tag)
         if not tag:
             await answer_command(task_id, f'{EMOJI_FAILED} Tag "{tag}" was not found', comment_id, todoist_api)
             return
@@ -234,27 +407,31 @@ async def process_command(
             return
 
         value = state == 'on'
-        await existio_api.attributes_update([
-            AttributeValue(name=tag, date=utils.format_date(target_date), value=value),
-        ])
-        await post_stats(task_id, tag, todoist_api, existio_api)
+        try:
+            await existio_api.attribute_update(
+                AttributeValue(name=tag, date=utils.format_date(target_date), value=value),
+            )
+        except ExistioError as e:
+            await answer_command(task_id, f'{EMOJI_FAILED} Exist.io update failed: {e}', comment_id, todoist_api)
+            return
+        await refresh_stats(task_id, data_manager, todoist_api, existio_api)
         return
     tag = command.strip('-').strip().replace(' ', '_')
     if not tag:
         await answer_command(task_id, 'Empty tag name', comment_id, todoist_api)
         return
-    await data_manager.store(task_id, tag)
+    await data_manager.store(task_id, tag, owner=owner)
     await delete_relevant_comment(task_id, todoist_api)
     await todoist_api.add_comment(existio_api.get_tag_url(tag), task_id=task_id)
     await existio_api.attributes_acquire([tag])
-    await post_stats(task_id, tag, todoist_api, existio_api)
+    await refresh_stats(task_id, data_manager, todoist_api, existio_api)
 
 
 async def answer_command(
         task_id: str,
         text: str,
         comment_id: str | None,
-        todoist_api: TodoistAPIAsync,
+        todoist_api: TodoistClient,
 ):
     if comment_id:
         await todoist_api.add_comment(text, task_id=task_id)
@@ -265,7 +442,7 @@ async def answer_command(
 async def task_updated(
         task: Task,
         data_manager: DataManager,
-        todoist_api: TodoistAPIAsync,
+        todoist_api: TodoistClient,
         existio_api: ExistioAPI,
 ):
     task_id = task.id
@@ -273,48 +450,54 @@ async def task_updated(
     if not description.startswith('/'):
         return
     command = description[1:]
-    await process_command(command, task_id, None, data_manager, todoist_api, existio_api)
+    await process_command(command, task_id, None, data_manager, todoist_api, existio_api, owner=task.user_id)
 
 
 async def task_completed(
         task: Task,
         data_manager: DataManager,
-        todoist_api: TodoistAPIAsync,
+        todoist_api: TodoistClient,
         existio_api: ExistioAPI,
 ):
     task_id = task.id
     tag = await data_manager.get(task_id)
     if not tag:
         return
+    tracing.annotate(tag=tag)
     if task.checked:
         await release_tag(task.id, data_manager, todoist_api, existio_api)
         return
-    await existio_api.attributes_update([
-        AttributeValue(name=tag, date=current_date()),
-    ])
-    await post_stats(task_id, tag, todoist_api, existio_api)
+    try:
+        await existio_api.attribute_update(AttributeValue(name=tag, date=current_date()))
+    except ExistioError as e:
+        logging.error(f'{task_id = }, {tag = }: Exist.io update failed: {e}')
+        return
+    await refresh_stats(task_id, data_manager, todoist_api, existio_api)
 
 
 async def task_uncompleted(
         task: Task,
         data_manager: DataManager,
-        todoist_api: TodoistAPIAsync,
+        todoist_api: TodoistClient,
         existio_api: ExistioAPI,
 ):
     task_id = task.id
     tag = await data_manager.get(task_id)
     if not tag:
         return
-    await existio_api.attributes_update([
-        AttributeValue(name=tag, date=current_date(), value=0),
-    ])
-    await post_stats(task_id, tag, todoist_api, existio_api)
+    tracing.annotate(tag=tag)
+    try:
+        await existio_api.attribute_update(AttributeValue(name=tag, date=current_date(), value=0))
+    except ExistioError as e:
+        logging.error(f'{task_id = }, {tag = }: Exist.io update failed: {e}')
+        return
+    await refresh_stats(task_id, data_manager, todoist_api, existio_api)
 
 
 async def task_deleted(
         task: Task,
         data_manager: DataManager,
-        todoist_api: TodoistAPIAsync,
+        todoist_api: TodoistClient,
         existio_api: ExistioAPI,
 ):
     await release_tag(task.id, data_manager, todoist_api, existio_api)
@@ -323,29 +506,65 @@ async def task_deleted(
 async def release_tag(
         task_id: str,
         data_manager: DataManager,
-        todoist_api: TodoistAPIAsync,
+        todoist_api: TodoistClient,
         existio_api: ExistioAPI,
 ):
     tag = await data_manager.get(task_id)
     if not tag:
         return
+    tracing.annotate(tag=tag)
+    stats_debouncer.cancel(task_id)
+    # the same tag can be connected to another task as well
+    if not [other_id for other_id in await data_manager.find_by_tag(tag) if other_id != task_id]:
+        await existio_api.attributes_release([tag])
+    try:
+        await delete_relevant_comment(task_id, todoist_api)
+    except requests.HTTPError as e:
+        # a deleted task has no comments left to clean up
+        if not is_not_found(e):
+            raise
+    # the last step: a retry of a job which failed before it still finds the tag
     await data_manager.remove(task_id)
-    await existio_api.attributes_release([tag])
-    await delete_relevant_comment(task_id, todoist_api)
 
 
-async def delete_relevant_comment(task_id: str, todoist_api: TodoistAPIAsync, include_exist_url=True):
+def is_not_found(e: requests.HTTPError) -> bool:
+    return e.response is not None and e.response.status_code == 404
+
+
+async def delete_comment_if_exists(comment_id: str, todoist_api: TodoistClient):
+    try:
+        await todoist_api.delete_comment(comment_id)
+    except requests.HTTPError as e:
+        # already deleted, e.g. by an earlier attempt of the same job
+        if not is_not_found(e):
+            raise
+
+
+async def delete_relevant_comment(task_id: str, todoist_api: TodoistClient, include_exist_url=True,
+                                  comments: list[ApiComment] = None) -> list[ApiComment]:
     search = [PREFIX_COMMAND, *EMOJIS]
     if include_exist_url:
         search.append(EXIST_PART_URL)
-    comments = await todoist_api.get_comments(task_id=task_id)
-    delete_comment_ids = [
-        comment.id
-        for comment in comments
-        if utils.string_contains(comment.content, *search)
-    ]
-    for comment_id in delete_comment_ids:
-        await todoist_api.delete_comment(comment_id)
+    if comments is None:
+        comments = await todoist_api.get_comments(task_id=task_id)
+    commands = todoist_api.commands()
+    kept_comments = []
+    for comment in comments:
+        if utils.string_contains(comment.content, *search):
+            commands.note_delete(comment.id)
+        else:
+            kept_comments.append(comment)
+    await commit_commands(commands)
+    # what is left of the task's comments
+    return kept_comments
+
+
+async def commit_commands(commands: SyncCommands):
+    if not commands:
+        return
+    failed = await commands.commit()
+    if failed:
+        raise TodoistSyncError(', '.join(f'{command.type}: {command.error}' for command in failed))
 
 
 EVEN_MAP = {
@@ -355,3 +574,45 @@ EVEN_MAP = {
     'item:uncompleted': task_uncompleted,
     'item:deleted': task_deleted,
 }
+
+# events of one task are handled one by one, different tasks still run in parallel
+task_locks = KeyedLock()
+# per task, set the delay to debounce stats refreshes
+stats_debouncer = Debouncer()
+# set to a load shedding check to defer stats refreshes under load
+shed_stats: Callable[[], bool] = lambda: False
+# seconds a shed stats refresh waits before it's tried again
+shed_stats_delay: float = 60.
+# set to queue a STATS_REFRESH_EVENT job for a task, the failed debounced refreshes are retried that way
+retry_stats: Callable[[str], Awaitable] | None = None
+STATS_REFRESH_EVENT = 'stats:refresh'
+
+
+def is_low_value(event_name: str, event_data: Task | Comment) -> bool:
+    # events which would only refresh the stats
+    if event_name == 'note:added':
+        command = event_data.content.strip().lower()[len(PREFIX_COMMAND):].strip()
+        return command == 'update'
+    if event_name == 'item:updated':
+        return event_data.description.strip()[1:] == 'update'
+    return False
+
+
+def event_task_id(event_data: Task | Comment) -> str:
+    if isinstance(event_data, Comment):
+        return event_data.item_id
+    return event_data.id
+
+
+async def dispatch(
+        event_name: str,
+        event_data: Task | Comment,
+        data_manager: DataManager,
+        todoist_api: TodoistClient,
+        existio_api: ExistioAPI,
+):
+    handler = EVEN_MAP[event_name]
+    async with task_locks(event_task_id(event_data)):
+        with HANDLER_LATENCY.time(handler=handler.__name__, status='error') as labels:
+            await handler(event_data, data_manager, todoist_api, existio_api)
+            labels['status'] = 'ok'
@@ -0,0 +1,224 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+
+import pytest
+
+from data_manager import DataManager, JournalDataManager, SQLiteDataManager, create_data_manager, write_atomic
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def fill(data_manager: DataManager):
+    await data_manager.store('1', 'one')
+    await data_manager.store('2', 'two')
+    await data_manager.store('1', 'uno')
+    await data_manager.remove('2')
+    await data_manager.store('3', 'three')
+    await data_manager.close()
+
+
+def test_write_atomic_concurrent_writes(tmp_path):
+    filename = str(tmp_path / 'pairs.txt')
+    errors = []
+
+    def write(i: int):
+        try:
+            for j in range(50):
+                write_atomic(filename, f'{i}:{j}')
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert os.listdir(tmp_path) == ['pairs.txt']
+    with open(filename) as f:
+        assert f.read().endswith(':49')
+
+
+def test_journal_replay(tmp_path):
+    filename = str(tmp_path / 'pairs.txt')
+    run(fill(JournalDataManager(filename)))
+
+    with open(f'{filename}.journal') as f:
+        assert f.read() == '+1:one\n+2:two\n+1:uno\n-2\n+3:three\n'
+    assert run(JournalDataManager(filename).all()) == {'1': 'uno', '3': 'three'}
+
+
+def test_journal_concurrent_stores_are_batched(tmp_path):
+    filename = str(tmp_path / 'pairs.txt')
+    data_manager = JournalDataManager(filename, flush_interval=1, flush_batch_size=10)
+
+    async def store_many():
+        await asyncio.gather(*[data_manager.store(str(i), f'tag{i}') for i in range(10)])
+        await data_manager.close()
+
+    run(store_many())
+
+    assert run(JournalDataManager(filename).all()) == dict((str(i), f'tag{i}') for i in range(10))
+
+
+def test_journal_compaction(tmp_path):
+    filename = str(tmp_path / 'pairs.txt')
+    run(fill(JournalDataManager(filename, compact_threshold=3)))
+
+    with open(f'{filename}.journal') as f:
+        # compacted after the third record
+        assert f.read() == '-2\n+3:three\n'
+    assert run(JournalDataManager(filename).all()) == {'1': 'uno', '3': 'three'}
+
+    async def compact():
+        data_manager = JournalDataManager(filename)
+        await data_manager.all()
+        await data_manager.compact()
+
+    run(compact())
+
+    with open(filename) as f:
+        assert sorted(f.read().splitlines()) == ['1:uno', '3:three']
+    with open(f'{filename}.journal') as f:
+        assert f.read() == ''
+    assert run(JournalDataManager(filename).all()) == {'1': 'uno', '3': 'three'}
+
+
+def test_journal_drops_torn_record(tmp_path):
+    filename = str(tmp_path / 'pairs.txt')
+    with open(f'{filename}.journal', 'w') as f:
+        f.write('+1:one\n+2:tw')
+
+    async def reload_and_store():
+        data_manager = JournalDataManager(filename)
+        assert await data_manager.all() == {'1': 'one'}
+        await data_manager.store('3', 'three')
+        await data_manager.close()
+
+    run(reload_and_store())
+
+    with open(f'{filename}.journal') as f:
+        assert f.read() == '+1:one\n+3:three\n'
+
+
+def test_journal_failed_append_keeps_mapping(tmp_path, monkeypatch):
+    filename = str(tmp_path / 'pairs.txt')
+    data_manager = JournalDataManager(filename)
+
+    def broken_write(text: str):
+        raise OSError('disk full')
+
+    async def store():
+        await data_manager.store('1', 'one')
+        monkeypatch.setattr(data_manager, '_write_journal', broken_write)
+        with pytest.raises(OSError):
+            await data_manager.store('1', 'uno')
+        with pytest.raises(OSError):
+            await data_manager.remove('1')
+        assert await data_manager.all() == {'1': 'one'}
+        await data_manager.close()
+
+    run(store())
+
+
+@pytest.mark.parametrize('backend', ['file', 'journal', 'sqlite'])
+def test_find_by_tag(tmp_path, backend):
+    data_manager = create_data_manager(backend, str(tmp_path / 'pairs.txt'), db_filename=str(tmp_path / 'pairs.db'))
+
+    async def find():
+        await data_manager.store('1', 'run')
+        await data_manager.store('2', 'read')
+        await data_manager.store('3', 'run')
+        await data_manager.remove('3')
+        try:
+            return await data_manager.find_by_tag('run'), await data_manager.find_by_tag('swim')
+        finally:
+            await data_manager.close()
+
+    assert run(find()) == (['1'], [])
+
+
+def new_shared(tmp_path, backend: str) -> DataManager:
+    return create_data_manager(backend, str(tmp_path / 'pairs.txt'), db_filename=str(tmp_path / 'pairs.db'),
+                               shared=True)
+
+
+def store_items(tmp_path, backend: str, items: list[tuple[str, str]]):
+    async def store():
+        data_manager = new_shared(tmp_path, backend)
+        for task_id, tag in items:
+            await data_manager.store(task_id, tag)
+        await data_manager.close()
+
+    run(store())
+
+
+def store_in_other_process(tmp_path, backend: str, items: list[tuple[str, str]]) -> multiprocessing.Process:
+    # a separate process, e.g. another uvicorn worker or a script run
+    process = multiprocessing.get_context('spawn').Process(target=store_items, args=(tmp_path, backend, items))
+    process.start()
+    return process
+
+
+@pytest.mark.parametrize('backend', ['file', 'journal', 'sqlite'])
+def test_shared_reload_after_another_process_writes(tmp_path, backend):
+    data_manager = new_shared(tmp_path, backend)
+
+    async def read():
+        await data_manager.store('1', 'one')
+        assert not await data_manager.has('2')
+        process = store_in_other_process(tmp_path, backend, [('1', 'uno'), ('2', 'two')])
+        await asyncio.to_thread(process.join)
+        assert process.exitcode == 0
+        try:
+            return await data_manager.has('2'), await data_manager.all()
+        finally:
+            await data_manager.close()
+
+    assert run(read()) == (True, {'1': 'uno', '2': 'two'})
+
+
+@pytest.mark.parametrize('backend', ['file', 'journal'])
+def test_shared_writes_of_two_processes_are_kept(tmp_path, backend):
+    data_manager = new_shared(tmp_path, backend)
+
+    async def write():
+        process = store_in_other_process(tmp_path, backend, [(f'a{i}', 'other') for i in range(20)])
+        for i in range(20):
+            await data_manager.store(f'b{i}', 'this')
+        await asyncio.to_thread(process.join)
+        assert process.exitcode == 0
+        try:
+            return await data_manager.all()
+        finally:
+            await data_manager.close()
+
+    data = run(write())
+
+    # every change is made on top of the other process' changes, none of them is lost
+    assert len(data) == 40
+
+
+def test_sqlite_find_by_owner(tmp_path):
+    filename = str(tmp_path / 'pairs.txt')
+    with open(filename, 'w') as f:
+        f.write('1:run\n')
+    data_manager = SQLiteDataManager(filename, str(tmp_path / 'pairs.db'))
+
+    async def find():
+        await data_manager.store('2', 'read', owner='alice')
+        await data_manager.store('3', 'swim', owner='bob')
+        # a migrated pair gets its owner once stored again, a store without an owner keeps it
+        await data_manager.store('1', 'run', owner='alice')
+        await data_manager.store('2', 'write')
+        try:
+            return await data_manager.find_by_owner('alice'), await data_manager.find_by_owner('carol')
+        finally:
+            await data_manager.close()
+
+    assert run(find()) == ({'1': 'run', '2': 'write'}, {})
@@ -0,0 +1,95 @@
+import asyncio
+from datetime import date
+
+import pytest
+from aiohttp import web
+
+from existio import AttributeValue, ExistioAPI, ExistioError, ExistioRequestError
+
+
+@pytest.mark.parametrize('today, closed_before', [
+    # the previous month is still re-rendered, its last day is "today" till the day slice hour of the 1st
+    ('2023-03-01', '2023-01-01'),
+    ('2023-03-02', '2023-02-01'),
+    ('2023-03-31', '2023-02-01'),
+    ('2023-01-01', '2022-11-01'),
+])
+def test_closed_before(today, closed_before):
+    assert ExistioAPI.closed_before(date.fromisoformat(today)) == date.fromisoformat(closed_before)
+
+
+class CountingExistio(ExistioAPI):
+    def __init__(self, **kwargs):
+        super().__init__('token', **kwargs)
+        self.requests = 0
+
+    async def get(self, path, params=None, **kwargs):
+        self.requests += 1
+        return dict(results=[dict(date=params['date_min'], value=1)])
+
+
+@pytest.mark.parametrize('shared, requests', [(False, 1), (True, 2)])
+def test_shared_cache_keeps_closed_days_briefly(monkeypatch, shared, requests):
+    # the writes of the other processes do not invalidate the cache of this one
+    existio_api = CountingExistio(cache_ttl_closed=86400, cache_ttl_current=60, shared=shared)
+    day = date(2020, 1, 1)
+    now = [1000.]
+    monkeypatch.setattr('cache.time.monotonic', lambda: now[0])
+    asyncio.run(existio_api.attribute_values('run', day, day))
+    now[0] += 61
+    assert asyncio.run(existio_api.attribute_values('run', day, day)) == {day: 1}
+    assert existio_api.requests == requests
+
+
+class FailingExistio(ExistioAPI):
+    def __init__(self, error: Exception = None, failed: list[dict] = ()):
+        super().__init__('token', update_window=.01)
+        self.error = error
+        self.failed = list(failed)
+
+    async def attributes_update(self, data):
+        if self.error is not None:
+            raise self.error
+        return self.failed
+
+
+def test_update_buffer_passes_request_errors_as_they_are():
+    async def update(existio_api: ExistioAPI):
+        await existio_api.attribute_update(AttributeValue('run', '2023-01-02'))
+
+    # a temporary failure stays retryable: not an ExistioError, which the handlers treat as a rejected value
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(update(FailingExistio(error=asyncio.TimeoutError())))
+    with pytest.raises(ExistioError, match='not_owner'):
+        asyncio.run(update(FailingExistio(failed=[dict(name='run', date='2023-01-02', error_code='not_owner')])))
+
+
+def test_error_status_is_raised_after_the_retries():
+    calls = []
+
+    async def unavailable(request: web.Request):
+        calls.append(request.path)
+        return web.json_response(dict(detail='unavailable'), status=503, headers={'Retry-After': '0'})
+
+    async def main():
+        app = web.Application()
+        app.add_routes([web.route('*', '/{path:.*}', unavailable)])
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', 0).start()
+        host, port = runner.addresses[0][:2]
+        existio_api = ExistioAPI('token', max_retries=1, base_url=f'http://{host}:{port}/api/2/')
+        existio_api._acquired.add('run')
+        try:
+            # not an empty result: the job fails and is retried instead of rendering nothing or losing the write
+            with pytest.raises(ExistioRequestError, match='503'):
+                await existio_api.attribute_update(AttributeValue('run', '2023-01-02'))
+            with pytest.raises(ExistioRequestError, match='503'):
+                await existio_api.attribute_values('run', date(2023, 1, 1), date(2023, 1, 2))
+        finally:
+            await existio_api.close()
+            await runner.cleanup()
+
+    asyncio.run(main())
+
+    assert calls == ['/api/2/attributes/update/'] * 2 + ['/api/2/attributes/values/'] * 2
@@ -0,0 +1,202 @@
+import asyncio
+import time
+
+import requests
+
+import tasks
+from data_manager import DataManager
+from jobqueue import Job, JobQueue
+from locks import Debouncer
+
+
+def new_queue(tmp_path, **kwargs) -> JobQueue:
+    kwargs.setdefault('backoff_base', .01)
+    queue = JobQueue(str(tmp_path / 'queue.sqlite3'), **kwargs)
+    queue.POLL_INTERVAL = .01
+    return queue
+
+
+def test_claim_keeps_key_order(tmp_path):
+    queue = new_queue(tmp_path)
+    for key, event_name in [('a', 'first'), ('a', 'second'), ('b', 'other')]:
+        assert queue._put(key, event_name, '{}')
+
+    first = queue._claim()
+    other = queue._claim()
+    # the second job of `a` waits for the first one
+    assert queue._claim() is None
+    assert (first.key, first.event_name) == ('a', 'first')
+    assert (other.key, other.event_name) == ('b', 'other')
+
+    queue._done(first)
+    second = queue._claim()
+    assert (second.key, second.event_name) == ('a', 'second')
+
+
+def test_put_deduplicates_deliveries(tmp_path):
+    queue = new_queue(tmp_path, deliveries_ttl=60)
+
+    async def put():
+        results = [
+            await queue.put('a', 'item:completed', '{}', delivery_key='d1'),
+            await queue.put('a', 'item:completed', '{}', delivery_key='d1'),
+            await queue.put('a', 'item:completed', '{}', delivery_key='d2'),
+            await queue.put('a', 'item:completed', '{}'),
+        ]
+        return results, await queue.stats()
+
+    results, stats = asyncio.run(put())
+
+    assert results == [True, False, True, True]
+    assert stats['depth'] == 3
+    assert stats['duplicates'] == 1
+
+
+def test_failed_job_is_retried_then_dead(tmp_path):
+    queue = new_queue(tmp_path, max_attempts=2)
+    queue._put('a', 'item:completed', '{}')
+
+    job = queue._claim()
+    assert queue._failed(job, 'boom')
+    # backing off
+    assert queue._claim() is None
+    time.sleep(.05)
+    job = queue._claim()
+    assert job.attempts == 1
+    assert not queue._failed(job, 'boom again')
+
+    assert queue._count() == 0
+    assert queue._execute('SELECT key, attempts, last_error FROM dead_jobs') == [('a', 2, 'boom again')]
+
+
+def test_expired_claim_is_claimed_again(tmp_path):
+    queue = new_queue(tmp_path, lease=.01)
+    queue._put('a', 'item:completed', '{}')
+
+    job = queue._claim()
+    time.sleep(.05)
+    # the lease of the first claim is over, its worker is considered gone
+    assert queue._claim() == job
+
+
+class FakeTodoist:
+    def __init__(self):
+        self.comments = {'c1'}
+        self.delete_calls = 0
+
+    async def delete_comment(self, comment_id: str):
+        self.delete_calls += 1
+        if comment_id not in self.comments:
+            response = requests.Response()
+            response.status_code = 404
+            raise requests.HTTPError('404 Not Found', response=response)
+        self.comments.discard(comment_id)
+
+
+class FakeExistio:
+    def __init__(self):
+        self.updates = []
+
+    async def attribute_update(self, item):
+        self.updates.append(item)
+
+
+def test_partly_failed_handler_is_retried(tmp_path, monkeypatch):
+    # existio:on:<date> deletes the command comment, updates Exist.io and refreshes the stats;
+    # the refresh fails once, the retry of the whole job has to get through the already deleted comment
+    data_manager = DataManager(str(tmp_path / 'pairs.txt'))
+    todoist_api = FakeTodoist()
+    existio_api = FakeExistio()
+    refreshes = []
+
+    async def post_current_stats(task_id, *args):
+        refreshes.append(task_id)
+        if len(refreshes) == 1:
+            raise ConnectionError('upstream is down')
+
+    monkeypatch.setattr(tasks, 'post_current_stats', post_current_stats)
+    queue = new_queue(tmp_path)
+
+    async def handler(job: Job):
+        await tasks.process_command(job.payload, job.key, 'c1', data_manager, todoist_api, existio_api)
+
+    async def run():
+        await data_manager.store('t1', 'run')
+        await queue.start(handler)
+        await queue.put('t1', 'note:added', 'on:2023-01-02')
+        while (await queue.stats())['depth']:
+            await asyncio.sleep(.01)
+        stats = await queue.stats()
+        await queue.stop()
+        return stats
+
+    stats = asyncio.run(run())
+
+    assert stats['dead'] == 0
+    assert todoist_api.delete_calls == 2
+    assert refreshes == ['t1', 't1']
+    assert [(item.name, item.date, item.value) for item in existio_api.updates] == [('run', '2023-01-02', True)] * 2
+
+
+def test_release_is_retried_until_the_mapping_is_removed(tmp_path, monkeypatch):
+    data_manager = DataManager(str(tmp_path / 'pairs.txt'))
+    releases = []
+
+    class ReleasingExistio:
+        async def attributes_release(self, names):
+            releases.append(names)
+            if len(releases) == 1:
+                raise ConnectionError('upstream is down')
+
+    async def delete_relevant_comment(task_id, todoist_api):
+        pass
+
+    monkeypatch.setattr(tasks, 'delete_relevant_comment', delete_relevant_comment)
+
+    async def run():
+        await data_manager.store('t1', 'run')
+        try:
+            await tasks.release_tag('t1', data_manager, None, ReleasingExistio())
+        except ConnectionError:
+            pass
+        # the failed attempt kept the mapping, so the retry still knows what to release
+        assert await data_manager.get('t1') == 'run'
+        await tasks.release_tag('t1', data_manager, None, ReleasingExistio())
+        return await data_manager.get('t1')
+
+    assert asyncio.run(run()) is None
+    assert releases == [['run'], ['run']]
+
+
+def test_shed_stats_refresh_is_deferred(monkeypatch):
+    overloaded = [True, True, True, False]
+    posted = []
+    queued = []
+
+    async def post_current_stats(task_id, *args):
+        posted.append(task_id)
+
+    async def retry_stats(task_id):
+        queued.append(task_id)
+
+    monkeypatch.setattr(tasks, 'post_current_stats', post_current_stats)
+    monkeypatch.setattr(tasks, 'retry_stats', retry_stats)
+    monkeypatch.setattr(tasks, 'shed_stats', lambda: overloaded.pop(0))
+    monkeypatch.setattr(tasks, 'shed_stats_delay', .01)
+    monkeypatch.setattr(tasks, 'stats_debouncer', Debouncer())
+
+    async def run():
+        # overloaded at the event and still overloaded after the delay: handed over to the queue
+        await tasks.refresh_stats('t1', None, None, None)
+        assert len(tasks.stats_debouncer) == 1
+        await asyncio.sleep(.05)
+        assert (posted, queued) == ([], ['t1'])
+        # the load is gone by the time the deferred refresh fires
+        await tasks.refresh_stats('t2', None, None, None)
+        assert posted == []
+        await asyncio.sleep(.05)
+
+    asyncio.run(run())
+
+    assert posted == ['t2']
+    assert queued == ['t1']
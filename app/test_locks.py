@@ -0,0 +1,152 @@
+import asyncio
+import multiprocessing
+import time
+
+from locks import Debouncer, KeyedLock
+
+
+def test_keyed_lock_runs_same_key_in_order():
+    locks = KeyedLock()
+    events = []
+
+    async def job(key: str, i: int):
+        async with locks(key):
+            events.append((key, i, 'start'))
+            await asyncio.sleep(.01)
+            events.append((key, i, 'end'))
+
+    async def main():
+        # started in this order, so they queue up on the lock in this order
+        await asyncio.gather(*[job('a', i) for i in range(5)])
+
+    asyncio.run(main())
+
+    assert events == [('a', i, stage) for i in range(5) for stage in ('start', 'end')]
+    assert len(locks) == 0
+
+
+def test_keyed_lock_runs_different_keys_in_parallel():
+    locks = KeyedLock()
+    running = 0
+    peak = 0
+
+    async def job(key: str):
+        nonlocal running, peak
+        async with locks(key):
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(.01)
+            running -= 1
+
+    async def main():
+        await asyncio.gather(*[job(str(i)) for i in range(5)])
+
+    asyncio.run(main())
+
+    assert peak == 5
+    assert len(locks) == 0
+
+
+def test_keyed_lock_survives_cancelled_waiter():
+    locks = KeyedLock()
+
+    async def main():
+        async with locks('a'):
+            waiter = asyncio.create_task(locks('a').__aenter__())
+            await asyncio.sleep(0)
+            waiter.cancel()
+            await asyncio.gather(waiter, return_exceptions=True)
+        assert len(locks) == 0
+        async with locks('a'):
+            assert locks.locked('a')
+
+    asyncio.run(main())
+
+
+def test_keyed_lock_with_lock_dir(tmp_path):
+    locks = KeyedLock(lock_dir=str(tmp_path))
+    events = []
+
+    async def job(i: int):
+        async with locks('a'):
+            events.append(i)
+            await asyncio.sleep(.01)
+            events.append(i)
+
+    async def main():
+        await asyncio.gather(*[job(i) for i in range(3)])
+
+    asyncio.run(main())
+
+    assert events == [0, 0, 1, 1, 2, 2]
+
+
+def hold_lock(lock_dir: str, events_filename: str):
+    async def hold():
+        async with KeyedLock(lock_dir=lock_dir)('a'):
+            with open(events_filename, 'a') as f:
+                f.write('held\n')
+            await asyncio.sleep(.2)
+            with open(events_filename, 'a') as f:
+                f.write('released\n')
+
+    asyncio.run(hold())
+
+
+def test_keyed_lock_with_lock_dir_across_processes(tmp_path):
+    lock_dir = str(tmp_path / 'locks')
+    events = tmp_path / 'events'
+    events.touch()
+    process = multiprocessing.get_context('spawn').Process(target=hold_lock, args=(lock_dir, str(events)))
+    process.start()
+    while not events.read_text():
+        time.sleep(.01)
+
+    async def main():
+        async with KeyedLock(lock_dir=lock_dir)('a'):
+            # the other process held the key until it was done with it
+            return events.read_text()
+
+    try:
+        assert asyncio.run(main()) == 'held\nreleased\n'
+    finally:
+        process.join()
+
+
+def test_debouncer_runs_last_call_once():
+    debouncer = Debouncer(delay=.05)
+    calls = []
+
+    async def call(key: str, value: int):
+        calls.append((key, value))
+
+    async def main():
+        for i in range(3):
+            debouncer.schedule('a', call, 'a', i)
+            await asyncio.sleep(.01)
+        debouncer.schedule('b', call, 'b', 0)
+        assert len(debouncer) == 2
+        await asyncio.sleep(.1)
+
+    asyncio.run(main())
+
+    assert sorted(calls) == [('a', 2), ('b', 0)]
+
+
+def test_debouncer_cancel_and_flush():
+    debouncer = Debouncer(delay=60)
+    calls = []
+
+    async def call(value: int):
+        calls.append(value)
+
+    async def main():
+        debouncer.schedule('a', call, 1)
+        debouncer.schedule('b', call, 2)
+        debouncer.cancel('a')
+        await debouncer.flush()
+        assert len(debouncer) == 0
+
+    asyncio.run(main())
+
+    assert calls == [2]
@@ -0,0 +1,133 @@
+import asyncio
+import os
+
+import aiohttp
+
+from todoist import SyncCommands, SyncState, TodoistSyncError
+
+
+class FakeSyncApi:
+    # answers the `commands` requests: note_add gets a real id, commands on the unknown notes fail
+
+    def __init__(self, fail_with: Exception = None):
+        self.requests: list[list[dict]] = []
+        self.notes = {'n1'}
+        self._fail_with = fail_with
+
+    async def sync(self, commands: list[dict]) -> dict:
+        self.requests.append(commands)
+        if self._fail_with is not None:
+            raise self._fail_with
+        sync_status = dict()
+        temp_id_mapping = dict()
+        for command in commands:
+            if command['type'] == 'note_add':
+                note_id = f'n{len(self.notes) + 1}'
+                self.notes.add(note_id)
+                temp_id_mapping[command['temp_id']] = note_id
+            elif command['args']['id'] not in self.notes:
+                sync_status[command['uuid']] = dict(error='Note not found', error_code=20)
+                continue
+            sync_status[command['uuid']] = 'ok'
+        return dict(sync_status=sync_status, temp_id_mapping=temp_id_mapping)
+
+
+def test_commit_maps_temp_ids():
+    api = FakeSyncApi()
+    commands = SyncCommands(api)
+    added = commands.note_add('t1', 'first')
+    updated = commands.note_update('n1', 'second')
+    added_too = commands.note_add('t1', 'third')
+
+    failed = asyncio.run(commands.commit())
+
+    assert failed == []
+    assert len(api.requests) == 1
+    assert added.result == 'n2'
+    assert added_too.result == 'n3'
+    assert updated.result is True
+    assert len(commands) == 0
+
+
+def test_commit_reports_failed_commands():
+    api = FakeSyncApi()
+    commands = SyncCommands(api)
+    added = commands.note_add('t1', 'first')
+    missing = commands.note_delete('n404')
+
+    failed = asyncio.run(commands.commit())
+
+    assert failed == [missing]
+    assert missing.result is None
+    assert missing.error == 'Note not found'
+    assert added.result == 'n2'
+
+
+def test_commit_chunks_commands():
+    api = FakeSyncApi()
+    commands = SyncCommands(api)
+    added = [commands.note_add('t1', str(i)) for i in range(250)]
+
+    assert asyncio.run(commands.commit()) == []
+    assert [len(chunk) for chunk in api.requests] == [100, 100, 50]
+    assert len(set(command.result for command in added)) == 250
+
+
+def test_commit_request_failure_fails_the_chunk():
+    for error in (TodoistSyncError('500: oops'), aiohttp.ClientConnectionError('refused')):
+        commands = SyncCommands(FakeSyncApi(fail_with=error))
+        added = commands.note_add('t1', 'first')
+
+        failed = asyncio.run(commands.commit())
+
+        assert failed == [added]
+        assert added.result is None
+        assert added.error == str(error)
+
+
+class FakeReadApi:
+    # the first read is a full sync, the next ones return only what changed since the given token
+
+    def __init__(self):
+        self.tokens: list[str] = []
+
+    async def sync(self, sync_token: str, resource_types: list[str]) -> dict:
+        self.tokens.append(sync_token)
+        if sync_token == '*':
+            return dict(
+                full_sync=True,
+                sync_token='token1',
+                items=[dict(id='t1', content='Habit')],
+                notes=[dict(id='n1', item_id='t1', content='first', posted_at='2023-01-01T00:00:00Z')],
+            )
+        return dict(
+            full_sync=False,
+            sync_token='token2',
+            items=[],
+            notes=[dict(id='n2', item_id='t1', content='second', posted_at='2023-01-02T00:00:00Z')],
+        )
+
+
+def test_sync_state_is_saved_between_runs(tmp_path):
+    filename = str(tmp_path / 'sync_state.json')
+    api = FakeReadApi()
+
+    asyncio.run(SyncState(api, filename=filename).refresh())
+    state = SyncState(api, filename=filename)
+    asyncio.run(state.refresh())
+
+    assert api.tokens == ['*', 'token1']
+    assert os.stat(filename).st_mode & 0o777 == 0o600
+    assert state.sync_token == 'token2'
+    assert list(state.items) == ['t1']
+    assert [comment.content for comment in state.get_comments('t1')] == ['first', 'second']
+
+
+def test_broken_sync_state_means_full_sync(tmp_path):
+    filename = tmp_path / 'sync_state.json'
+    filename.write_text('{')
+    api = FakeReadApi()
+
+    asyncio.run(SyncState(api, filename=str(filename)).refresh())
+
+    assert api.tokens == ['*']
@@ -0,0 +1,164 @@
+import asyncio
+
+import pytest
+from todoist_api_python.models import Comment as ApiComment
+
+import tasks
+from data_manager import DataManager
+from todoist import TodoistSyncError
+from updater import Progress, Updater
+
+
+class FakeExistio:
+    async def attribute_values(self, tag, date_min, date_max):
+        return dict()
+
+
+class FakeSyncState:
+    items = dict()
+
+    async def refresh(self):
+        pass
+
+    def get_comments(self, task_id: str):
+        return []
+
+
+def new_updater(tmp_path, raise_errors=False) -> Updater:
+    data_manager = DataManager(str(tmp_path / 'pairs.txt'))
+    return Updater(data_manager, None, FakeExistio(), run_filename=str(tmp_path / 'update_all.run'),
+                   fingerprints_filename=str(tmp_path / 'fingerprints.json'), raise_errors=raise_errors)
+
+
+@pytest.fixture
+def failing_delete(monkeypatch):
+    # the comments of t2 can't be deleted
+    posted = []
+
+    async def delete_relevant_comment(task_id, todoist_api, include_exist_url=True, comments=None):
+        if task_id == 't2':
+            raise TodoistSyncError('note_delete: Service unavailable')
+        return []
+
+    async def post_stats(task_id, *args, **kwargs):
+        posted.append(task_id)
+        return []
+
+    monkeypatch.setattr(tasks, 'delete_relevant_comment', delete_relevant_comment)
+    monkeypatch.setattr(tasks, 'post_stats', post_stats)
+    return posted
+
+
+async def fill(updater: Updater, count: int):
+    for i in range(1, count + 1):
+        await updater.data_manager.store(f't{i}', f'tag{i}')
+
+
+def test_update_all_failed_delete_fails_only_its_task(tmp_path, failing_delete):
+    updater = new_updater(tmp_path)
+
+    async def update():
+        await fill(updater, 3)
+        return await updater.update_all(force=True, update_months=1, concurrency=2, sync_state=FakeSyncState(),
+                                        progress=Progress(output=lambda line: None))
+
+    progress = asyncio.run(update())
+
+    assert sorted(failing_delete) == ['t1', 't3']
+    assert progress.done == 3
+    assert progress.failed == [('t2', 'tag2')]
+    # the failed task is not checkpointed, `resume` tries it again
+    assert sorted((tmp_path / 'update_all.run').read_text().split()) == ['t1', 't3']
+
+
+def test_update_all_raise_errors_stops_all_workers(tmp_path, failing_delete):
+    updater = new_updater(tmp_path, raise_errors=True)
+
+    async def update():
+        await fill(updater, 20)
+        with pytest.raises(TodoistSyncError):
+            await updater.update_all(force=True, update_months=1, concurrency=2, spread=1,
+                                     sync_state=FakeSyncState(), progress=Progress(output=lambda line: None))
+        # the error stopped the run right away, nothing is left running after it
+        posted = len(failing_delete)
+        await asyncio.sleep(.2)
+        assert posted == len(failing_delete) < 5
+
+    asyncio.run(update())
+
+
+def test_update_task_failed_delete(tmp_path, failing_delete):
+    updater = new_updater(tmp_path)
+
+    async def update():
+        await fill(updater, 2)
+        return await updater.update_task('t2', force=True, update_months=1)
+
+    assert asyncio.run(update()) is False
+    assert failing_delete == []
+
+
+class FakeTodoistState(FakeSyncState):
+    # the comments and descriptions as posted by the fake post_stats
+
+    def __init__(self):
+        self.comments: dict[str, list[str]] = dict()
+        self.items = dict()
+
+    def get_comments(self, task_id: str):
+        return [
+            ApiComment(attachment=None, content=content, id=f'{task_id}-{i}', posted_at=None, project_id=None,
+                       task_id=task_id)
+            for i, content in enumerate(self.comments.get(task_id) or [])
+        ]
+
+
+def test_update_all_incremental_restores_deleted_comment(tmp_path, monkeypatch):
+    updater = new_updater(tmp_path)
+    state = FakeTodoistState()
+    posted = []
+
+    async def post_stats(task_id, tag, *args, **kwargs):
+        posted.append(task_id)
+        text = tasks.generate_stats_header(tasks.stats_months(1)[-1]) + '\n1/1'
+        state.comments[task_id] = [text]
+        state.items[task_id] = dict(description='description')
+        return [text, 'description']
+
+    monkeypatch.setattr(tasks, 'post_stats', post_stats)
+
+    async def update():
+        await fill(updater, 2)
+        return await updater.update_all(force=False, update_months=1, incremental=True, sync_state=state,
+                                        progress=Progress(output=lambda line: None))
+
+    asyncio.run(update())
+    assert asyncio.run(update()).unchanged == 2
+    # somebody deleted the stats comment in Todoist
+    state.comments['t2'] = []
+    progress = asyncio.run(update())
+
+    assert progress.unchanged == 1
+    assert posted == ['t1', 't2', 't2']
+
+
+def test_update_all_spreads_only_the_writes(tmp_path, monkeypatch):
+    updater = new_updater(tmp_path)
+    state = FakeTodoistState()
+
+    async def post_stats(task_id, tag, *args, **kwargs):
+        state.items[task_id] = dict(description='description')
+        return ['description']
+
+    monkeypatch.setattr(tasks, 'post_stats', post_stats)
+
+    async def update():
+        return await updater.update_all(force=False, update_months=1, incremental=True, spread=.5,
+                                        sync_state=state, progress=Progress(output=lambda line: None))
+
+    asyncio.run(fill(updater, 10))
+    assert asyncio.run(update()).elapsed >= .45
+    # nothing to write: no waiting either
+    progress = asyncio.run(update())
+    assert progress.unchanged == 10
+    assert progress.elapsed < .2
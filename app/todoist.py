@@ -1,17 +1,41 @@
-from typing import Any
+import asyncio
+import json
+import logging
+import os
+import uuid
+from typing import Any, Awaitable
+from urllib.parse import urljoin
 
+import aiohttp
+import requests
 from pydantic import BaseModel, Field
+from todoist_api_python import endpoints
+from todoist_api_python.api import TodoistAPI
+from todoist_api_python.api_async import TodoistAPIAsync
+from todoist_api_python.models import Comment as ApiComment
+
+import tracing
+import utils
+from data_manager import write_atomic
+from metrics import track_upstream
 
 __all__ = [
     'API_VERSION',
     'Comment',
     'Initiator',
+    'SyncCommand',
+    'SyncCommands',
+    'SyncState',
     'Task',
+    'TodoistClient',
+    'TodoistSyncError',
     'Webhook',
 ]
 
 API_VERSION = '9'
 
+logger = logging.getLogger(__name__)
+
 
 class Due(BaseModel):
     date: str
@@ -89,3 +113,240 @@ class Webhook(BaseModel):
                 "version": "9",
             },
         }
+
+
+class TodoistSyncError(Exception):
+    pass
+
+
+class SyncCommand:
+    def __init__(self, type_: str, args: dict, temp_id: str = None):
+        self.type = type_
+        self.args = args
+        self.uuid = str(uuid.uuid4())
+        self.temp_id = temp_id
+        # filled in by SyncCommands.commit()
+        self.result: str | bool | None = None
+        self.error: str | None = None
+
+    def as_dict(self):
+        data = dict(type=self.type, uuid=self.uuid, args=self.args)
+        if self.temp_id:
+            data['temp_id'] = self.temp_id
+        return data
+
+
+class SyncCommands:
+    # Sync API write queue: everything collected goes upstream in one `commands` request
+
+    def __init__(self, todoist_api: 'TodoistClient'):
+        self._todoist_api = todoist_api
+        self._commands: list[SyncCommand] = []
+
+    def __len__(self):
+        return len(self._commands)
+
+    def _add(self, command: SyncCommand) -> SyncCommand:
+        self._commands.append(command)
+        return command
+
+    def note_add(self, item_id: str, content: str) -> SyncCommand:
+        return self._add(SyncCommand('note_add', dict(item_id=item_id, content=content), temp_id=str(uuid.uuid4())))
+
+    def note_update(self, note_id: str, content: str) -> SyncCommand:
+        return self._add(SyncCommand('note_update', dict(id=note_id, content=content)))
+
+    def note_delete(self, note_id: str) -> SyncCommand:
+        return self._add(SyncCommand('note_delete', dict(id=note_id)))
+
+    def item_update(self, item_id: str, **kwargs) -> SyncCommand:
+        return self._add(SyncCommand('item_update', dict(id=item_id, **kwargs)))
+
+    async def commit(self) -> list[SyncCommand]:
+        commands, self._commands = self._commands, []
+        failed = []
+        for chunk in utils.chunks(commands, TodoistClient.LIMIT_MAXIMUM_COMMANDS):
+            try:
+                result = await self._todoist_api.sync(commands=[command.as_dict() for command in chunk])
+            except (aiohttp.ClientError, TodoistSyncError) as e:
+                for command in chunk:
+                    command.error = str(e) or repr(e)
+                failed.extend(chunk)
+                continue
+            sync_status = result.get('sync_status') or dict()
+            temp_id_mapping = result.get('temp_id_mapping') or dict()
+            for command in chunk:
+                status = sync_status.get(command.uuid)
+                if status == 'ok':
+                    command.result = temp_id_mapping.get(command.temp_id) if command.temp_id else True
+                else:
+                    command.error = status.get('error') if isinstance(status, dict) else repr(status)
+                    failed.append(command)
+        for command in failed:
+            logger.error(f'{command.type} {command.args} failed: {command.error}')
+        return failed
+
+
+class SyncState:
+    # local mirror of items and notes, kept up to date with incremental Sync API reads;
+    # with `filename` it is saved there after every read, so the next run continues incrementally
+
+    def __init__(self, todoist_api: 'TodoistClient', filename: str = None):
+        self._todoist_api = todoist_api
+        self._filename = filename
+        self._loaded = False
+        self.sync_token = '*'
+        self.items: dict[str, dict] = dict()
+        self.notes: dict[str, dict] = dict()
+        self._notes_by_item: dict[str, list[dict]] = dict()
+
+    def _load(self):
+        if not self._filename or not os.path.exists(self._filename):
+            return
+        try:
+            with open(self._filename) as f:
+                state = json.load(f)
+        except ValueError as e:
+            # a full sync rebuilds it
+            logger.warning(f'ignoring broken sync state {self._filename}: {e}')
+            return
+        self.sync_token = state.get('sync_token') or '*'
+        self.items = state.get('items') or dict()
+        self.notes = state.get('notes') or dict()
+
+    def _save(self):
+        # a copy of the whole account (all items and notes): readable for the owner only
+        write_atomic(self._filename, json.dumps(dict(sync_token=self.sync_token, items=self.items, notes=self.notes)),
+                     mode=0o600)
+
+    async def refresh(self):
+        if not self._loaded:
+            self._loaded = True
+            await asyncio.to_thread(self._load)
+        result = await self._todoist_api.sync(sync_token=self.sync_token, resource_types=['items', 'notes'])
+        if result.get('full_sync'):
+            self.items.clear()
+            self.notes.clear()
+        for item in result.get('items') or []:
+            if item.get('is_deleted'):
+                self.items.pop(item['id'], None)
+            else:
+                self.items[item['id']] = item
+        for note in result.get('notes') or []:
+            if note.get('is_deleted'):
+                self.notes.pop(note['id'], None)
+            else:
+                self.notes[note['id']] = note
+        self.sync_token = result.get('sync_token') or self.sync_token
+        if self._filename:
+            await asyncio.to_thread(self._save)
+        self._notes_by_item.clear()
+        for note in sorted(self.notes.values(), key=lambda note: note.get('posted_at') or ''):
+            self._notes_by_item.setdefault(note['item_id'], []).append(note)
+        logger.debug(f'synced {len(self.items)} items and {len(self.notes)} notes')
+
+    def get_comments(self, task_id: str) -> list[ApiComment]:
+        return [
+            ApiComment(
+                attachment=None,
+                content=note['content'],
+                id=note['id'],
+                posted_at=note.get('posted_at'),
+                project_id=note.get('project_id'),
+                task_id=note['item_id'],
+            )
+            for note in self._notes_by_item.get(task_id) or []
+        ]
+
+
+class RestSession(requests.Session):
+    # todoist_api_python builds its REST URLs from a module global, this session sends them to `rest_url` instead
+
+    def __init__(self, rest_url: str):
+        super().__init__()
+        self.rest_url = rest_url
+
+    def request(self, method, url, *args, **kwargs):
+        if url.startswith(endpoints.REST_API):
+            url = self.rest_url + url[len(endpoints.REST_API):]
+        return super().request(method, url, *args, **kwargs)
+
+
+class TodoistClient(TodoistAPIAsync):
+    SYNC_URL = f'https://api.todoist.com/sync/v{API_VERSION}/sync'
+
+    LIMIT_MAXIMUM_COMMANDS = 100
+
+    _session: aiohttp.ClientSession | None = None
+
+    def __init__(self, token: str, timeout=30, base_url: str = None):
+        super().__init__(token)
+        self._token = token
+        self._timeout = timeout
+        if base_url:
+            # e.g. a local stand-in for the benchmarks, only this client is pointed there
+            self.SYNC_URL = urljoin(base_url, f'/sync/v{API_VERSION}/sync')
+            self._api = TodoistAPI(token, session=RestSession(urljoin(base_url, f'/rest/{endpoints.REST_VERSION}/')))
+
+    async def start(self):
+        if self._session is not None and not self._session.closed:
+            return
+        self._session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=self._timeout),
+            headers=dict(Authorization=f'Bearer {self._token}'),
+        )
+
+    async def close(self):
+        if self._session is None:
+            return
+        await self._session.close()
+        self._session = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def sync(self, **data) -> dict:
+        if self._session is None or self._session.closed:
+            await self.start()
+        form = dict(
+            (key, value if isinstance(value, str) else json.dumps(value))
+            for key, value in data.items()
+        )
+        endpoint = 'sync:commands' if 'commands' in data else 'sync:read'
+        with tracing.span('todoist', endpoint=endpoint), track_upstream('todoist', endpoint) as call:
+            async with self._session.post(self.SYNC_URL, data=form) as response:
+                call['status'] = response.status
+                logger.debug(f'sync status: {response.status}')
+                if response.status != 200:
+                    raise TodoistSyncError(f'{response.status}: {await response.text()}')
+                return await response.json()
+
+    async def _rest(self, endpoint: str, request: Awaitable):
+        with tracing.span('todoist', endpoint=endpoint), track_upstream('todoist', endpoint) as call:
+            try:
+                response = await request
+            except requests.HTTPError as e:
+                if e.response is not None:
+                    call['status'] = e.response.status_code
+                raise
+            call['status'] = 200
+            return response
+
+    async def get_comments(self, **kwargs) -> list[ApiComment]:
+        return await self._rest('get_comments', super().get_comments(**kwargs))
+
+    async def add_comment(self, content: str, **kwargs) -> ApiComment:
+        return await self._rest('add_comment', super().add_comment(content, **kwargs))
+
+    async def delete_comment(self, comment_id: str, **kwargs) -> bool:
+        return await self._rest('delete_comment', super().delete_comment(comment_id, **kwargs))
+
+    async def update_task(self, task_id: str, **kwargs) -> bool:
+        return await self._rest('update_task', super().update_task(task_id, **kwargs))
+
+    def commands(self) -> SyncCommands:
+        return SyncCommands(self)
@@ -0,0 +1,137 @@
+import collections
+import json
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+__all__ = [
+    'Span',
+    'Trace',
+    'annotate',
+    'sample_stacks',
+    'span',
+    'trace',
+]
+
+logger = logging.getLogger(__name__)
+
+# traces longer than this many seconds are logged as JSON (0 - never)
+slow_threshold: float = 0
+
+_trace: ContextVar['Trace | None'] = ContextVar('trace', default=None)
+_span: ContextVar['Span | None'] = ContextVar('span', default=None)
+
+
+class Span:
+    __slots__ = ('id', 'parent_id', 'name', 'attributes', 'started', 'duration', 'error')
+
+    def __init__(self, id_: int, parent_id: int | None, name: str, attributes: dict):
+        self.id = id_
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.started = time.perf_counter()
+        self.duration: float | None = None
+        self.error: str | None = None
+
+    def as_dict(self, trace_started: float) -> dict:
+        return dict(
+            id=self.id,
+            parent_id=self.parent_id,
+            name=self.name,
+            start=round(self.started - trace_started, 6),
+            duration=round(self.duration, 6) if self.duration is not None else None,
+            error=self.error,
+            **self.attributes,
+        )
+
+
+class Trace:
+    # all the spans of one unit of work (a job, a script task), shared by the asyncio tasks it spawns
+
+    def __init__(self, name: str, attributes: dict):
+        self.name = name
+        # task_id, tag, event ids: common to every span of the trace
+        self.attributes = attributes
+        self.spans: list[Span] = []
+        self.started = time.perf_counter()
+        self.duration: float | None = None
+        self.error: str | None = None
+
+    def as_dict(self) -> dict:
+        return dict(
+            trace=self.name,
+            duration=round(self.duration, 6) if self.duration is not None else None,
+            error=self.error,
+            **self.attributes,
+            spans=[s.as_dict(self.started) for s in self.spans],
+        )
+
+
+@contextmanager
+def trace(name: str, **attributes):
+    current = Trace(name, attributes)
+    trace_token = _trace.set(current)
+    span_token = _span.set(None)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = repr(e)
+        raise
+    finally:
+        current.duration = time.perf_counter() - current.started
+        _span.reset(span_token)
+        _trace.reset(trace_token)
+        if 0 < slow_threshold <= current.duration:
+            logger.warning(f'slow {name}: {json.dumps(current.as_dict(), default=str)}')
+
+
+@contextmanager
+def span(name: str, **attributes):
+    # outside of a trace it costs nearly nothing and records nothing
+    current_trace = _trace.get()
+    if current_trace is None:
+        yield None
+        return
+    parent = _span.get()
+    current = Span(len(current_trace.spans), parent.id if parent else None, name, attributes)
+    current_trace.spans.append(current)
+    token = _span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = repr(e)
+        raise
+    finally:
+        current.duration = time.perf_counter() - current.started
+        _span.reset(token)
+
+
+def annotate(**attributes):
+    # e.g. the tag, once the handler has read it
+    current_trace = _trace.get()
+    if current_trace is not None:
+        current_trace.attributes.update(attributes)
+
+
+def sample_stacks(thread_id: int, seconds: float, interval: float = .005) -> str:
+    # Sampling profiler for a live thread (the event loop), run it in another thread.
+    # Returns collapsed stacks ("outer;inner count" lines), the input format of flamegraph tools.
+    stacks = collections.Counter()
+    deadline = time.monotonic() + seconds
+    current = threading.get_ident()
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is None or thread_id == current:
+            break
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f'{code.co_filename.rsplit("/", 1)[-1]}:{code.co_name}')
+            frame = frame.f_back
+        stacks[';'.join(reversed(names))] += 1
+        time.sleep(interval)
+    return '\n'.join(f'{stack} {count}' for stack, count in stacks.most_common()) + '\n'
@@ -0,0 +1,255 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Callable
+
+import tasks
+import tracing
+from data_manager import DataManager, write_atomic
+from existio import ExistioAPI
+from todoist import SyncState, TodoistClient
+
+__all__ = [
+    'Progress',
+    'Updater',
+]
+
+logger = logging.getLogger(__name__)
+
+
+def read_fingerprints(filename: str) -> dict[str, str]:
+    if not os.path.exists(filename):
+        return dict()
+    with open(filename) as f:
+        return json.load(f)
+
+
+def read_run_file(filename: str) -> set[str]:
+    if not os.path.exists(filename):
+        return set()
+    with open(filename) as f:
+        return set(line.strip() for line in f if line.strip())
+
+
+class Progress:
+    def __init__(self, total: int = 0, output: Callable[[str], None] = print):
+        self.total = total
+        self.done = 0
+        self.unchanged = 0
+        self.failed: list[tuple[str, str]] = []
+        self.started = time.monotonic()
+        self.finished: float | None = None
+        self.output = output
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def rate(self) -> float:
+        return self.done / self.elapsed if self.elapsed else 0.
+
+    @property
+    def eta(self) -> float:
+        return (self.total - self.done) / self.rate if self.rate else 0.
+
+    def update(self, task_id: str, tag: str, status: str):
+        self.done += 1
+        if status == 'unchanged':
+            self.unchanged += 1
+        elif status == 'failed':
+            self.failed.append((task_id, tag))
+        self.output(f'[{self.done}/{self.total}] {task_id} ({tag}): {status}, {self.rate:.2f} tasks/s, '
+                    f'ETA {self.eta:.0f}s')
+
+    def finish(self):
+        self.finished = time.monotonic()
+        updated = self.done - self.unchanged - len(self.failed)
+        self.output(f'{updated} of {self.total} tasks updated in {self.elapsed:.1f}s, {self.unchanged} unchanged, '
+                    f'{len(self.failed)} failed')
+        for task_id, tag in self.failed:
+            self.output(f'  FAILED: {task_id} ({tag})')
+
+    def as_dict(self) -> dict:
+        return dict(
+            total=self.total,
+            done=self.done,
+            unchanged=self.unchanged,
+            failed=[task_id for task_id, _ in self.failed],
+            elapsed=self.elapsed,
+            rate=self.rate,
+            eta=self.eta,
+            finished=self.finished is not None,
+        )
+
+
+class Updater:
+    # Stats refreshes of the tracked tasks, shared by script.py and the admin API of the app
+
+    def __init__(self, data_manager: DataManager, todoist_api: TodoistClient, existio_api: ExistioAPI,
+                 run_filename: str, fingerprints_filename: str, sync_state_filename: str = None, raise_errors=False):
+        self.data_manager = data_manager
+        self.todoist_api = todoist_api
+        self.existio_api = existio_api
+        # completed task ids of the last update_all, for `resume`
+        self.run_filename = run_filename
+        # what was rendered last time per task, for `incremental`
+        self.fingerprints_filename = fingerprints_filename
+        # Sync API state between the runs, for an incremental read
+        self.sync_state_filename = sync_state_filename
+        self.raise_errors = raise_errors
+
+    async def update_task_stats(self, task_id, tag, update_months: int, comments=None, values=None,
+                                current_description: str = None) -> list[str] | None:
+        # the posted texts (see tasks.post_stats), None - failed
+        try:
+            logger.info(f'starting {task_id = }, {tag = }')
+            # waits for the webhook jobs of the task (across processes with SHARED_STATE)
+            async with tasks.task_locks(task_id):
+                with tracing.trace('update_task', task_id=task_id, tag=tag):
+                    texts = await tasks.post_stats(task_id, tag, self.todoist_api, self.existio_api,
+                                                   update_months=update_months, force=False, comments=comments,
+                                                   values=values, current_description=current_description)
+            logger.info(f'finished {task_id = }, {tag = }')
+        except Exception as e:
+            self._failure(task_id, tag, e)
+            return None
+        else:
+            logger.info(f'SUCCESS: {task_id = }, {tag = }')
+            logger.debug('Stats:\n%s\n', '--\n'.join(texts))
+            return texts
+
+    def _failure(self, task_id: str, tag: str, e: Exception):
+        logger.warning(f'FAILURE: {task_id = }, {tag = }')
+        if self.raise_errors:
+            raise e
+        logger.error(e)
+
+    async def update_task(self, task_id: str, force: bool, update_months: int) -> bool | None:
+        # None - the task is not tracked
+        tag = await self.data_manager.get(task_id)
+        if not tag:
+            return None
+        if force:
+            try:
+                await tasks.delete_relevant_comment(task_id, self.todoist_api, include_exist_url=False)
+            except Exception as e:
+                self._failure(task_id, tag, e)
+                return False
+        return await self.update_task_stats(task_id, tag, update_months) is not None
+
+    async def update_description(self, task_id: str, show_days: int) -> str | None:
+        tag = await self.data_manager.get(task_id)
+        if not tag:
+            return None
+        description = await tasks.generate_description(tag, self.existio_api, show_days=show_days)
+        async with tasks.task_locks(task_id):
+            await self.todoist_api.update_task(task_id, description=description)
+        return description
+
+    async def update_all(self, force: bool, update_months: int, concurrency: int = 10, resume=False,
+                         incremental=False, spread: float = 0, sync_state: SyncState = None,
+                         progress: Progress = None, run_filename: str = None) -> Progress:
+        # `spread`: the upstream writes are spaced evenly over this many seconds instead of all at once,
+        # the unchanged tasks of an `incremental` run are not delayed;
+        # `run_filename`: a checkpoint file of its own instead of the shared one (see `daemon` in script.py)
+        run_filename = run_filename or self.run_filename
+        data = await self.data_manager.all()
+        fingerprints = read_fingerprints(self.fingerprints_filename)
+        completed = read_run_file(run_filename) if resume else set()
+        pending = [
+            (task_id, tag)
+            for task_id, tag in data.items()
+            if task_id not in completed
+        ]
+        if progress is None:
+            progress = Progress()
+        progress.total = len(pending)
+        if completed:
+            progress.output(f'resuming: {len(data) - len(pending)} tasks are already done')
+        # one Sync API read instead of fetching comments task by task (incremental for a reused state)
+        if sync_state is None:
+            sync_state = SyncState(self.todoist_api, filename=self.sync_state_filename)
+        await sync_state.refresh()
+        queue = asyncio.Queue()
+        for task_id, tag in pending:
+            queue.put_nowait((task_id, tag))
+        step = spread / len(pending) if pending else 0
+        next_write_at = time.monotonic()
+
+        async def wait_for_write():
+            # the writes keep at least `step` apart, workers take the slots in turn
+            nonlocal next_write_at
+            now = time.monotonic()
+            write_at = max(now, next_write_at)
+            next_write_at = write_at + step
+            if write_at > now:
+                await asyncio.sleep(write_at - now)
+
+        async def update(task_id: str, tag: str) -> str:
+            # errors are raised, `worker` records the task as failed
+            date_min = tasks.stats_date_min(update_months)
+            # the whole span is read for every task: only a long-running process (the app, `daemon`) gets
+            # the closed months from its Exist.io cache, a run from cron starts with an empty one
+            values = await self.existio_api.attribute_values(tag, date_min=date_min, date_max=tasks.local_today())
+            comments = sync_state.get_comments(task_id)
+            current_description = (sync_state.items.get(task_id) or dict()).get('description')
+            if incremental and not force:
+                # the values and what is in Todoist are the same as after the last update of the task
+                texts = tasks.posted_stats_texts(comments, current_description, update_months)
+                if fingerprints.get(task_id) == tasks.values_fingerprint(tag, values, date_min, texts):
+                    return 'unchanged'
+            await wait_for_write()
+            if force:
+                # deletes go task by task, so a resumed run does not redo them for finished tasks
+                comments = await tasks.delete_relevant_comment(task_id, self.todoist_api,
+                                                               include_exist_url=False, comments=comments)
+            texts = await self.update_task_stats(task_id, tag, update_months, comments=comments, values=values,
+                                                 current_description=current_description)
+            if texts is None:
+                return 'failed'
+            fingerprints[task_id] = tasks.values_fingerprint(tag, values, date_min, texts)
+            return 'ok'
+
+        async def worker(run_file):
+            while not queue.empty():
+                task_id, tag = queue.get_nowait()
+                try:
+                    status = await update(task_id, tag)
+                except Exception as e:
+                    # one failed task does not stop the run
+                    progress.update(task_id, tag, 'failed')
+                    self._failure(task_id, tag, e)
+                    continue
+                if status != 'failed':
+                    # checkpoint: `resume` skips it
+                    run_file.write(f'{task_id}\n')
+                    run_file.flush()
+                progress.update(task_id, tag, status)
+
+        try:
+            # a fresh run starts a fresh checkpoint
+            with open(run_filename, 'a' if resume else 'w') as run_file:
+                workers = [
+                    asyncio.create_task(worker(run_file))
+                    for _ in range(max(1, concurrency))
+                ]
+                try:
+                    await asyncio.gather(*workers)
+                finally:
+                    # a raised error (`raise_errors`) or a cancelled run stops the other workers too
+                    for task in workers:
+                        task.cancel()
+                    await asyncio.gather(*workers, return_exceptions=True)
+        finally:
+            # released tasks are forgotten
+            kept_fingerprints = dict(
+                (task_id, fingerprint)
+                for task_id, fingerprint in fingerprints.items()
+                if task_id in data
+            )
+            await asyncio.to_thread(write_atomic, self.fingerprints_filename, json.dumps(kept_fingerprints))
+        progress.finish()
+        return progress
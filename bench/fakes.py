@@ -0,0 +1,224 @@
+import asyncio
+import hashlib
+import json
+import random
+import time
+import uuid
+from datetime import date, datetime, timedelta
+
+from aiohttp import web
+
+__all__ = [
+    'FakeExist',
+    'FakeServer',
+    'FakeTodoist',
+]
+
+
+class FakeServer:
+    # Local stand-in of an upstream API: every request waits `latency` (± `jitter`) seconds,
+    # fails with 503 at `error_rate` and gets 429 + Retry-After above `rate_limit` requests per second (0 - no limit)
+
+    def __init__(self, latency=.02, jitter=.01, error_rate=0., rate_limit=0., seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.random = random.Random(seed)
+        # endpoint -> count
+        self.requests: dict[str, int] = dict()
+        self.errors = 0
+        self.limited = 0
+        self._window_started = time.monotonic()
+        self._window_requests = 0
+        self.app = web.Application(middlewares=[self._middleware])
+        self._runner: web.AppRunner | None = None
+        self.url: str | None = None
+
+    def reset_counters(self):
+        self.requests.clear()
+        self.errors = self.limited = 0
+
+    @property
+    def total_requests(self) -> int:
+        return sum(self.requests.values())
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler):
+        resource = request.match_info.route.resource
+        endpoint = f'{request.method} {resource.canonical if resource is not None else request.path}'
+        self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+        if self.rate_limit > 0:
+            now = time.monotonic()
+            if now - self._window_started >= 1:
+                self._window_started = now
+                self._window_requests = 0
+            self._window_requests += 1
+            if self._window_requests > self.rate_limit:
+                self.limited += 1
+                retry_after = max(1, round(1 - (now - self._window_started)))
+                return web.json_response(dict(detail='rate limited'), status=429,
+                                         headers={'Retry-After': str(retry_after)})
+        delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response(dict(detail='fake failure'), status=503)
+        return await handler(request)
+
+    async def start(self, host='127.0.0.1', port=0):
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        # the port the OS picked for port 0
+        port = self._runner.addresses[0][1]
+        self.url = f'http://{host}:{port}'
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+class FakeExist(FakeServer):
+    # /api/2/attributes/*: values are derived from (attribute, date), so every run sees the same data
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.updates: dict[tuple[str, str], int] = dict()
+        self.app.add_routes([
+            web.get('/api/2/attributes/values/', self.values),
+            web.post('/api/2/attributes/acquire/', self.names_success),
+            web.post('/api/2/attributes/release/', self.names_success),
+            web.post('/api/2/attributes/create/', self.names_success),
+            web.post('/api/2/attributes/update/', self.update),
+        ])
+
+    def value(self, attribute: str, day: date) -> int:
+        if (attribute, day.isoformat()) in self.updates:
+            return self.updates[attribute, day.isoformat()]
+        digest = hashlib.sha1(f'{attribute}:{day.isoformat()}'.encode()).digest()
+        return int(digest[0] < 180)
+
+    async def values(self, request: web.Request):
+        attribute = request.query['attribute']
+        date_min = date.fromisoformat(request.query['date_min'])
+        date_max = date.fromisoformat(request.query['date_max'])
+        limit = int(request.query.get('limit', 31))
+        results = []
+        day = date_max
+        while day >= date_min and len(results) < limit:
+            results.append(dict(date=day.isoformat(), value=self.value(attribute, day)))
+            day -= timedelta(days=1)
+        return web.json_response(dict(count=len(results), next=None, previous=None, results=results))
+
+    async def names_success(self, request: web.Request):
+        data = await request.json()
+        return web.json_response(dict(success=data, failed=[]))
+
+    async def update(self, request: web.Request):
+        data = await request.json()
+        for item in data:
+            self.updates[item['name'], item['date']] = int(item['value'])
+        return web.json_response(dict(success=data, failed=[]))
+
+
+class FakeTodoist(FakeServer):
+    # the REST v2 comments/tasks endpoints and the Sync v9 items/notes resources, kept in memory
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.items: dict[str, dict] = dict()
+        self.notes: dict[str, dict] = dict()
+        self.app.add_routes([
+            web.get('/rest/v2/comments', self.get_comments),
+            web.post('/rest/v2/comments', self.add_comment),
+            web.post('/rest/v2/comments/{id}', self.update_comment),
+            web.delete('/rest/v2/comments/{id}', self.delete_comment),
+            web.post('/rest/v2/tasks/{id}', self.update_task),
+            web.post('/sync/v9/sync', self.sync),
+        ])
+
+    def add_item(self, item_id: str, user_id: str, content: str):
+        self.items[item_id] = dict(
+            id=item_id, user_id=user_id, content=content, description='', checked=False, completed_at=None,
+            is_deleted=False, project_id='1',
+        )
+
+    def _add_note(self, item_id: str, content: str) -> dict:
+        note = dict(
+            id=uuid.uuid4().hex[:12], item_id=item_id, project_id='1', content=content,
+            posted_at=datetime.utcnow().isoformat() + 'Z', attachment=None, is_deleted=False,
+        )
+        self.notes[note['id']] = note
+        return note
+
+    @staticmethod
+    def _comment(note: dict) -> dict:
+        return dict(
+            attachment=None, content=note['content'], id=note['id'], posted_at=note['posted_at'],
+            project_id=note['project_id'], task_id=note['item_id'],
+        )
+
+    async def get_comments(self, request: web.Request):
+        task_id = request.query.get('task_id')
+        return web.json_response([
+            self._comment(note)
+            for note in self.notes.values()
+            if note['item_id'] == task_id
+        ])
+
+    async def add_comment(self, request: web.Request):
+        data = await request.json()
+        return web.json_response(self._comment(self._add_note(data['task_id'], data['content'])))
+
+    async def update_comment(self, request: web.Request):
+        data = await request.json()
+        note = self.notes.get(request.match_info['id'])
+        if note is None:
+            return web.json_response(dict(error='not found'), status=404)
+        note['content'] = data['content']
+        return web.json_response(self._comment(note))
+
+    async def delete_comment(self, request: web.Request):
+        self.notes.pop(request.match_info['id'], None)
+        return web.Response(status=204)
+
+    async def update_task(self, request: web.Request):
+        data = await request.json()
+        item = self.items.get(request.match_info['id'])
+        if item is None:
+            return web.json_response(dict(error='not found'), status=404)
+        item.update(data)
+        return web.json_response(item)
+
+    async def sync(self, request: web.Request):
+        form = await request.post()
+        if 'commands' in form:
+            sync_status = dict()
+            temp_id_mapping = dict()
+            for command in json.loads(form['commands']):
+                args = command['args']
+                if command['type'] == 'note_add':
+                    note = self._add_note(args['item_id'], args['content'])
+                    temp_id_mapping[command['temp_id']] = note['id']
+                elif command['type'] == 'note_update' and args['id'] in self.notes:
+                    self.notes[args['id']]['content'] = args['content']
+                elif command['type'] == 'note_delete':
+                    self.notes.pop(args['id'], None)
+                elif command['type'] == 'item_update' and args['id'] in self.items:
+                    self.items[args['id']].update((key, value) for key, value in args.items() if key != 'id')
+                else:
+                    sync_status[command['uuid']] = dict(error='not found', error_code=20)
+                    continue
+                sync_status[command['uuid']] = 'ok'
+            return web.json_response(dict(sync_status=sync_status, temp_id_mapping=temp_id_mapping,
+                                          sync_token=uuid.uuid4().hex))
+        # reads are always full: good enough for the benchmarks
+        return web.json_response(dict(
+            full_sync=True,
+            sync_token=uuid.uuid4().hex,
+            items=list(self.items.values()),
+            notes=list(self.notes.values()),
+        ))
@@ -0,0 +1,285 @@
+# Offline benchmarks of the webhook pipeline and update_all against local stand-ins of Exist.io and Todoist.
+#
+#   python bench/run.py --tasks 200 --webhooks 2000 --latency 0.05 --error-rate 0.01
+#   python bench/run.py --scenario update_all --tasks 500 --env DATA_BACKEND=sqlite
+#
+# Run it as a script, not with `python -m`: like the app modules, it imports its sibling fakes.py directly.
+import argparse
+import asyncio
+import base64
+import contextlib
+import hashlib
+import hmac
+import io
+import json
+import logging
+import os
+import random
+import resource
+import socket
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import aiohttp
+
+from fakes import FakeExist, FakeTodoist
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'app')
+CLIENT_SECRET = 'bench'
+USER_ID = '1000'
+
+# event name -> weight of the generated stream; note:added and item:updated are mostly no-op events
+EVENT_MIX = {
+    'item:completed': 40,
+    'item:uncompleted': 10,
+    'note:added': 30,
+    'item:updated': 20,
+}
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def task_payload(task_id: str) -> dict:
+    return dict(
+        id=task_id, user_id=USER_ID, content=f'Habit {task_id}', description='', checked=False,
+        completed_at=None, is_deleted=False, project_id='1',
+    )
+
+
+def generate_webhooks(task_ids: list[str], count: int, seed: int) -> list[dict]:
+    rnd = random.Random(seed)
+    names = list(EVENT_MIX)
+    weights = list(EVENT_MIX.values())
+    webhooks = []
+    for i in range(count):
+        event_name = rnd.choices(names, weights)[0]
+        task = task_payload(rnd.choice(task_ids))
+        if event_name == 'note:added':
+            event_data = dict(id=f'n{i}', content='just a note', posted_uid=USER_ID, item_id=task['id'], item=task)
+        else:
+            event_data = task
+        webhooks.append(dict(event_name=event_name, user_id=USER_ID, event_data=event_data,
+                             initiator=dict(id=USER_ID), version='9'))
+    return webhooks
+
+
+def sign(body: bytes) -> str:
+    return base64.b64encode(hmac.new(CLIENT_SECRET.encode(), msg=body, digestmod=hashlib.sha256).digest()).decode()
+
+
+def upstream_report(exist: FakeExist, todoist: FakeTodoist, events: int) -> dict:
+    return dict(
+        exist_calls=exist.total_requests,
+        todoist_calls=todoist.total_requests,
+        exist_calls_per_event=exist.total_requests / events if events else 0.,
+        todoist_calls_per_event=todoist.total_requests / events if events else 0.,
+        exist_endpoints=dict(exist.requests),
+        todoist_endpoints=dict(todoist.requests),
+        injected_errors=exist.errors + todoist.errors,
+        rate_limited=exist.limited + todoist.limited,
+    )
+
+
+async def bench_webhooks(args, exist: FakeExist, todoist: FakeTodoist, task_ids: list[str]) -> dict:
+    import uvicorn
+
+    import main
+
+    jobs: list[float] = []
+    run_job = main.run_job
+
+    async def timed_run_job(job):
+        started = time.perf_counter()
+        try:
+            await run_job(job)
+        finally:
+            jobs.append(time.perf_counter() - started)
+
+    # the queue workers take the handler by reference on start
+    main.run_job = timed_run_job
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(main.app, log_level='warning', lifespan='on'))
+    serving = asyncio.create_task(server.serve(sockets=[sock]))
+    while not server.started:
+        await asyncio.sleep(.01)
+
+    webhooks = generate_webhooks(task_ids, args.webhooks, args.seed)
+    exist.reset_counters()
+    todoist.reset_counters()
+    responses: list[float] = []
+    statuses: dict[str, int] = dict()
+    queue = asyncio.Queue()
+    for i, webhook in enumerate(webhooks):
+        queue.put_nowait((i, json.dumps(webhook).encode()))
+
+    async def sender(session: aiohttp.ClientSession):
+        while not queue.empty():
+            i, body = queue.get_nowait()
+            headers = {
+                'Content-Type': 'application/json',
+                'X-Todoist-HMAC-SHA256': sign(body),
+                'X-Todoist-Delivery-ID': f'bench-{args.seed}-{i}',
+            }
+            started = time.perf_counter()
+            async with session.post(f'http://127.0.0.1:{port}/todoist/', data=body, headers=headers) as response:
+                text = await response.text()
+            responses.append(time.perf_counter() - started)
+            key = f'{response.status} {text.strip(chr(34))}'
+            statuses[key] = statuses.get(key, 0) + 1
+
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*[sender(session) for _ in range(args.senders)])
+    sent = time.perf_counter() - started
+    # the queue drains in background
+    while (await main.job_queue.stats())['depth'] or len(main.tasks.stats_debouncer):
+        await asyncio.sleep(.05)
+    drained = time.perf_counter() - started
+
+    server.should_exit = True
+    await serving
+    main.run_job = run_job
+    return dict(
+        webhooks=len(webhooks),
+        webhooks_per_second=len(webhooks) / sent if sent else 0.,
+        response_p50=percentile(responses, .5),
+        response_p99=percentile(responses, .99),
+        responses=statuses,
+        jobs=len(jobs),
+        jobs_per_second=len(jobs) / drained if drained else 0.,
+        handler_p50=percentile(jobs, .5),
+        handler_p99=percentile(jobs, .99),
+        drained_in=drained,
+        **upstream_report(exist, todoist, len(webhooks)),
+    )
+
+
+async def bench_update_all(args, exist: FakeExist, todoist: FakeTodoist) -> dict:
+    import script
+
+    exist.reset_counters()
+    todoist.reset_counters()
+    started = time.perf_counter()
+    # the per-task progress lines are not the point here
+    with contextlib.redirect_stdout(io.StringIO()):
+        failed = await script.run(script.process_all_tasks(False, None, concurrency=args.concurrency,
+                                                           incremental=args.incremental))
+    elapsed = time.perf_counter() - started
+    return dict(
+        tasks=args.tasks,
+        failed=len(failed),
+        elapsed=elapsed,
+        tasks_per_second=args.tasks / elapsed if elapsed else 0.,
+        **upstream_report(exist, todoist, args.tasks),
+    )
+
+
+def print_report(name: str, report: dict):
+    print(f'== {name}')
+    for key, value in report.items():
+        if isinstance(value, float):
+            value = f'{value * 1000:.1f} ms' if key.endswith(('_p50', '_p99')) else f'{value:.3f}'
+        print(f'  {key}: {value}')
+
+
+async def bench(args) -> dict:
+    fake_kwargs = dict(latency=args.latency, jitter=args.latency / 2, error_rate=args.error_rate,
+                       rate_limit=args.rate_limit, seed=args.seed)
+    exist = FakeExist(**fake_kwargs)
+    todoist = FakeTodoist(**fake_kwargs)
+    await exist.start()
+    await todoist.start()
+    task_ids = [str(100000 + i) for i in range(args.tasks)]
+    for task_id in task_ids:
+        todoist.add_item(task_id, USER_ID, f'Habit {task_id}')
+
+    workdir = tempfile.mkdtemp(prefix='habist-bench-')
+    with open(os.path.join(workdir, 'pairs.txt'), 'w') as f:
+        f.write('\n'.join(f'{task_id}:bench_habit_{i}' for i, task_id in enumerate(task_ids)))
+    os.environ.update(
+        DEBUG='false',
+        TODOIST_CLIENT_SECRET=CLIENT_SECRET,
+        TODOIST_API_KEY='bench',
+        EXISTIO_API_KEY='bench',
+        EXISTIO_BASE_URL=f'{exist.url}/api/2/',
+        TODOIST_BASE_URL=todoist.url,
+        DATA_FILENAME=os.path.join(workdir, 'pairs.txt'),
+        DATA_DB_FILENAME=os.path.join(workdir, 'pairs.sqlite3'),
+        ACQUIRED_FILENAME=os.path.join(workdir, 'acquired.txt'),
+        QUEUE_FILENAME=os.path.join(workdir, 'queue.sqlite3'),
+        LOCK_DIR=os.path.join(workdir, 'locks'),
+        UPDATE_ALL_RUN_FILENAME=os.path.join(workdir, 'update_all.run'),
+        DAEMON_RUN_FILENAME=os.path.join(workdir, 'daemon.run'),
+        UPDATE_ALL_FINGERPRINTS_FILENAME=os.path.join(workdir, 'fingerprints.json'),
+        SYNC_STATE_FILENAME=os.path.join(workdir, 'sync_state.json'),
+        QUEUE_MAX_PENDING='0',
+        EXISTIO_RATE_LIMIT='0',
+    )
+    for item in args.env:
+        key, _, value = item.partition('=')
+        os.environ[key] = value
+    # config reads .env.example relative to the working directory, the app modules import each other directly
+    os.chdir(APP_DIR)
+    sys.path.insert(0, APP_DIR)
+    logging.basicConfig(level=logging.WARNING)
+
+    reports = dict(
+        started_at=datetime.now().isoformat(timespec='seconds'),
+        settings=vars(args),
+    )
+    try:
+        if args.scenario in ('webhooks', 'all'):
+            reports['webhooks'] = await bench_webhooks(args, exist, todoist, task_ids)
+        if args.scenario in ('update_all', 'all'):
+            reports['update_all'] = await bench_update_all(args, exist, todoist)
+    finally:
+        await exist.stop()
+        await todoist.stop()
+    reports['memory'] = dict(
+        max_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        tracemalloc_peak_mb=tracemalloc.get_traced_memory()[1] / 2 ** 20 if tracemalloc.is_tracing() else None,
+    )
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks with local Exist.io and Todoist stand-ins')
+    parser.add_argument('--scenario', choices=['webhooks', 'update_all', 'all'], default='all')
+    parser.add_argument('--tasks', type=int, default=100, help='Tracked tasks (synthetic habits)')
+    parser.add_argument('--webhooks', type=int, default=1000, help='Webhook deliveries to replay')
+    parser.add_argument('--senders', type=int, default=20, help='Concurrent webhook senders')
+    parser.add_argument('--concurrency', type=int, default=10, help='update_all concurrency')
+    parser.add_argument('--incremental', action='store_true', help='Run update_all incrementally')
+    parser.add_argument('--latency', type=float, default=.02, help='Upstream latency, seconds')
+    parser.add_argument('--error-rate', type=float, default=0., help='Share of upstream requests failing with 503')
+    parser.add_argument('--rate-limit', type=float, default=0., help='Upstream requests per second before 429')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='App setting override, e.g. DATA_BACKEND=sqlite')
+    parser.add_argument('--tracemalloc', action='store_true', help='Report the peak of Python allocations (slower)')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args()
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    reports = asyncio.run(bench(args))
+    if args.json:
+        print(json.dumps(reports, indent=2))
+        return
+    for name in ('webhooks', 'update_all', 'memory'):
+        if name in reports:
+            print_report(name, reports[name])
+
+
+if __name__ == '__main__':
+    main()